@@ -0,0 +1,447 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Local stand-in for the Moodle/VPL endpoints used by mapi.py
+# Only the markup and form fields that mapi reads or submits are reproduced
+
+from typing import Dict, List, Optional, Tuple
+import argparse
+import contextlib
+import html
+import json
+import random
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+VPL_SUFFIX = '<span class="accesshide "> Laboratório Virtual de Programação</span>'
+
+
+class FakeVpl:
+    def __init__(self, qid: int, section: int, title: str, description: str = ""):
+        self.id: int = qid
+        self.section: int = section
+        self.title: str = title
+        self.description: str = description
+        self.duedate: str = "0"
+        self.maxfiles: str = "3"
+        self.options: Dict[str, str] = {"run": "0", "debug": "0", "evaluate": "0", "automaticgrading": "0"}
+        self.execution_files: List[Dict] = []
+        self.required_files: List[Dict] = []
+        self.keep: List[str] = []
+
+
+class FakeCourse:
+    def __init__(self, course_id: str, sections: int):
+        self.id: str = course_id
+        self.section_labels: List[str] = ["Tópico %d" % i for i in range(sections)]
+        self.vpls: Dict[int, FakeVpl] = {}
+        self.next_id: int = 1000
+        self.lock = threading.Lock()
+
+    def add_vpl(self, section: int, title: str, description: str = "") -> FakeVpl:
+        with self.lock:
+            self.next_id += 1
+            vpl = FakeVpl(self.next_id, section, title, description)
+            self.vpls[vpl.id] = vpl
+            return vpl
+
+    def populate(self, count: int, first_label: int = 1):
+        for i in range(count):
+            label = "%03d" % (first_label + i)
+            section = i % len(self.section_labels)
+            vpl = self.add_vpl(section, "@%s questão %s" % (label, label), "<p>descrição %s</p>" % label)
+            vpl.execution_files = [{"name": "vpl_evaluate.cases", "contents": "case=\ninput=1\noutput=1\n",
+                                    "encoding": 0}]
+
+
+class Settings:
+    def __init__(self, username="user", password="pass", latency=0.0, fail_rate=0.0, session_ttl=0.0,
+                 session_lock=True):
+        self.username: str = username
+        self.password: str = password
+        self.latency: float = latency  # seconds added to every response
+        self.fail_rate: float = fail_rate  # probability of answering 503
+        self.session_ttl: float = session_ttl  # 0 means sessions never expire
+        self.session_lock: bool = session_lock  # requests of one session answered one at a time, as moodle does
+
+
+class FakeMoodle:
+    def __init__(self, course: FakeCourse, settings: Settings):
+        self.course = course
+        self.settings = settings
+        self.remote: Dict[str, str] = {}  # target -> mapi.json text
+        self.sessions: Dict[str, Tuple[str, float]] = {}  # cookie -> (sesskey, creation)
+        self.session_locks: Dict[str, threading.Lock] = {}  # cookie -> lock held while answering
+        self.counter: Dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    def count(self, endpoint: str):
+        with self.lock:
+            self.counter[endpoint] = self.counter.get(endpoint, 0) + 1
+
+    def total_requests(self) -> int:
+        with self.lock:
+            return sum(self.counter.values())
+
+    def reset_counter(self):
+        with self.lock:
+            self.counter = {}
+
+    def new_session(self) -> Tuple[str, str]:
+        cookie = "%032x" % random.getrandbits(128)
+        sesskey = "%010x" % random.getrandbits(40)
+        with self.lock:
+            self.sessions[cookie] = (sesskey, time.time())
+        return cookie, sesskey
+
+    def session_lock(self, cookie: Optional[str]):
+        if cookie is None or not self.settings.session_lock:
+            return contextlib.nullcontext()
+        with self.lock:
+            return self.session_locks.setdefault(cookie, threading.Lock())
+
+    def sesskey(self, cookie: Optional[str]) -> Optional[str]:
+        with self.lock:
+            if cookie is None or cookie not in self.sessions:
+                return None
+            sesskey, created = self.sessions[cookie]
+            if self.settings.session_ttl and time.time() - created > self.settings.session_ttl:
+                del self.sessions[cookie]
+                return None
+            return sesskey
+
+
+class Page:
+    @staticmethod
+    def wrap(title: str, body: str, sesskey: str = "") -> str:
+        return ('<!DOCTYPE html><html><head><title>%s</title></head><body>'
+                '<script>M.cfg = {"sesskey":"%s"};</script>%s</body></html>') % (html.escape(title), sesskey, body)
+
+    @staticmethod
+    def error(message: str) -> str:
+        return Page.wrap("Erro", '<div data-rel="fatalerror" class="box errorbox alert alert-danger">%s</div>'
+                         % html.escape(message))
+
+    @staticmethod
+    def login() -> str:
+        return Page.wrap("Acessar", '<form action="/login/index.php" method="post" id="login">'
+                                    '<input type="hidden" name="logintoken" value="tok">'
+                                    '<input type="text" name="username" value="">'
+                                    '<input type="password" name="password" value="">'
+                                    '<button type="submit" id="loginbtn">Acessar</button></form>')
+
+    @staticmethod
+    def hidden(name: str, value) -> str:
+        return '<input type="hidden" name="%s" value="%s">' % (name, html.escape(str(value)))
+
+    @staticmethod
+    def select(name: str, values: List[str], current: str) -> str:
+        options = "".join('<option value="%s"%s>%s</option>' % (v, " selected" if v == current else "", v)
+                          for v in values)
+        return '<select name="%s">%s</select>' % (name, options)
+
+    @staticmethod
+    def section(course: FakeCourse, index: int, base: str) -> str:
+        items = []
+        for vpl in sorted(course.vpls.values(), key=lambda v: v.id):
+            if vpl.section != index:
+                continue
+            items.append('<li class="activity vpl modtype_vpl" id="module-%d"><div><div class="mod-indent-outer">'
+                         '<div class="mod-indent"></div><div><div class="activityinstance">'
+                         '<a class="aalink" href="%s/mod/vpl/view.php?id=%d"><img src="icon.svg" class="iconlarge">'
+                         '<span class="instancename">%s%s</span></a></div></div></div></div></li>'
+                         % (vpl.id, base, vpl.id, html.escape(vpl.title), VPL_SUFFIX))
+        label = html.escape(course.section_labels[index])
+        return ('<li id="section-%d" class="section main clearfix" role="region" aria-label="%s">'
+                '<div class="left side"></div><div class="content"><h3 class="sectionname">%s</h3>'
+                '<ul class="section img-text">%s</ul></div></li>') % (index, label, label, "".join(items))
+
+    @staticmethod
+    def course(course: FakeCourse, base: str, sesskey: str, section: Optional[int] = None) -> str:
+        indexes = range(len(course.section_labels))
+        if section is not None:
+            indexes = [0, section] if section != 0 else [0]
+        sections = "".join(Page.section(course, i, base) for i in indexes)
+        return Page.wrap("Curso: Fake %s" % course.id, '<div class="course-content"><ul class="topics">%s</ul></div>'
+                         % sections, sesskey)
+
+    @staticmethod
+    def modedit(vpl: Optional[FakeVpl], course: FakeCourse, section: int, sesskey: str) -> str:
+        title = "" if vpl is None else vpl.title
+        descr = "" if vpl is None else vpl.description
+        duedate = "0" if vpl is None else vpl.duedate
+        enabled = duedate != "0"
+        year, month, day, hour, minute = duedate.split(":") if enabled else ("2020", "1", "1", "0", "0")
+        fields = [Page.hidden("course", course.id), Page.hidden("section", section),
+                  Page.hidden("add", "vpl" if vpl is None else "0"), Page.hidden("update", 0 if vpl is None else vpl.id),
+                  Page.hidden("sesskey", sesskey), Page.hidden("_qf__mod_vpl_mod_form", 1),
+                  '<input type="text" name="name" value="%s">' % html.escape(title),
+                  '<textarea name="introeditor[text]">%s</textarea>' % html.escape(descr),
+                  '<input type="checkbox" name="duedate[enabled]" value="1"%s>' % (" checked" if enabled else ""),
+                  Page.select("duedate[year]", [str(y) for y in range(2018, 2031)], year),
+                  Page.select("duedate[month]", [str(m) for m in range(1, 13)], str(int(month))),
+                  Page.select("duedate[day]", [str(d) for d in range(1, 32)], str(int(day))),
+                  Page.select("duedate[hour]", [str(h) for h in range(0, 24)], str(int(hour))),
+                  Page.select("duedate[minute]", [str(m) for m in range(0, 60)], str(int(minute))),
+                  '<input type="text" name="maxfiles" value="%s">' % ("3" if vpl is None else vpl.maxfiles),
+                  '<input type="submit" name="submitbutton2" value="Salvar e voltar ao curso">',
+                  '<input type="submit" name="submitbutton" value="Salvar e mostrar">']
+        return Page.wrap("Editando", '<form action="modedit.php" method="post" id="mform1">%s</form>'
+                         % "".join(fields), sesskey)
+
+    @staticmethod
+    def execution_options(vpl: FakeVpl, sesskey: str) -> str:
+        fields = [Page.hidden("id", vpl.id), Page.hidden("sesskey", sesskey)]
+        fields += [Page.select(name, ["0", "1"], value) for name, value in vpl.options.items()]
+        fields += ['<input type="submit" name="savebutton" value="Salvar">']
+        return Page.wrap("Opções de execução", '<form action="executionoptions.php" method="post">%s</form>'
+                         % "".join(fields), sesskey)
+
+    @staticmethod
+    def keep_files(vpl: FakeVpl, sesskey: str) -> str:
+        fields = [Page.hidden("id", vpl.id), Page.hidden("sesskey", sesskey)]
+        # the four vpl scripts come first in the keep list, like in the real form
+        for index, file in enumerate(vpl.execution_files, start=4):
+            checked = " checked" if file["name"] in vpl.keep else ""
+            fields.append('<input type="checkbox" name="keepfile%d" value="1"%s>' % (index, checked))
+        fields.append('<input type="submit" name="savebutton" value="Salvar">')
+        return Page.wrap("Arquivos mantidos", '<form action="executionkeepfiles.php" method="post">%s</form>'
+                         % "".join(fields), sesskey)
+
+    @staticmethod
+    def view(vpl: FakeVpl, base: str, sesskey: str) -> str:
+        body = ['<a href="%s/mod/vpl/view.php?id=%d">%s</a>' % (base, vpl.id, html.escape(vpl.title)),
+                '<div class="box py-3 generalbox"><div class="no-overflow">%s</div></div>' % vpl.description]
+        counter = 0
+        for header, files in (("Arquivos requeridos", vpl.required_files),
+                              ("Arquivos de execução", vpl.execution_files)):
+            if len(files) == 0:
+                continue
+            body.append("<h2>%s</h2>" % header)
+            for file in files:
+                counter += 1
+                body.append('<h4 id="fileid%d">%s</h4><pre id="codefileid%d">%s</pre>'
+                            % (counter, html.escape(file["name"]), counter, html.escape(file["contents"])))
+        return Page.wrap(vpl.title, "".join(body), sesskey)
+
+    @staticmethod
+    def delete(vpl: FakeVpl, sesskey: str) -> str:
+        fields = [Page.hidden("delete", vpl.id), Page.hidden("confirm", 1), Page.hidden("sesskey", sesskey),
+                  '<button type="submit">Sim</button>']
+        return Page.wrap("Excluir", '<form action="/course/mod.php" method="post">%s</form>' % "".join(fields),
+                         sesskey)
+
+
+class Handler(BaseHTTPRequestHandler):
+    server_version = "FakeMoodle/1.0"
+    moodle: FakeMoodle = None
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def do_GET(self):
+        self.dispatch("GET")
+
+    def do_POST(self):
+        self.dispatch("POST")
+
+    def base(self) -> str:
+        return "http://%s:%d" % self.server.server_address[:2]
+
+    def send(self, status: int, body: str = "", content_type: str = "text/html; charset=utf-8",
+             headers: Optional[Dict[str, str]] = None):
+        data = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(data)
+
+    def redirect(self, location: str, headers: Optional[Dict[str, str]] = None):
+        headers = dict(headers or {})
+        headers["Location"] = location
+        self.send(303, "", headers=headers)
+
+    def cookie(self) -> Optional[str]:
+        for part in self.headers.get("Cookie", "").split(";"):
+            name, _, value = part.strip().partition("=")
+            if name == "MoodleSession":
+                return value
+        return None
+
+    def read_body(self) -> bytes:
+        length = int(self.headers.get("Content-Length", 0) or 0)
+        return self.rfile.read(length) if length > 0 else b""
+
+    def dispatch(self, method: str):
+        moodle = self.moodle
+        settings = moodle.settings
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        body = self.read_body()
+        endpoint = url.path.rsplit("/", 1)[-1].replace(".php", "")
+        moodle.count(endpoint)
+        if url.path.startswith("/remote/"):
+            if settings.latency > 0:
+                time.sleep(settings.latency)
+            return self.remote(url.path[len("/remote/"):])
+        with moodle.session_lock(self.cookie()):
+            if settings.latency > 0:
+                time.sleep(settings.latency)
+            return self.answer(method, url, query, body)
+
+    def answer(self, method: str, url: urllib.parse.SplitResult, query: Dict[str, str], body: bytes):
+        moodle = self.moodle
+        settings = moodle.settings
+        if settings.fail_rate > 0 and random.random() < settings.fail_rate:
+            return self.send(503, Page.error("Serviço indisponível"))
+        if url.path == "/login/index.php":
+            return self.login(method, body)
+        sesskey = moodle.sesskey(self.cookie())
+        if sesskey is None:
+            return self.redirect("/login/index.php")
+        form = dict(urllib.parse.parse_qsl(body.decode("utf-8"))) if method == "POST" else {}
+        if method == "POST" and "sesskey" in form and form["sesskey"] != sesskey:
+            return self.send(200, Page.error("A chave de sessão é inválida (invalidsesskey)"))
+        course = moodle.course
+        try:
+            if url.path == "/course/view.php":
+                section = int(query["section"]) if "section" in query else None
+                if section is not None and section >= len(course.section_labels):
+                    return self.send(404, Page.error("Não foi possível encontrar o registro (course_sections)"))
+                return self.send(200, Page.course(course, self.base(), sesskey, section))
+            if url.path == "/course/modedit.php":
+                return self.modedit(method, query, form, sesskey)
+            if url.path == "/course/mod.php":
+                return self.delete(method, query, form, sesskey)
+            if url.path == "/mod/vpl/view.php":
+                return self.send(200, Page.view(course.vpls[int(query["id"])], self.base(), sesskey))
+            if url.path == "/mod/vpl/forms/executionoptions.php":
+                vpl = course.vpls[int(form.get("id", query.get("id")))]
+                if method == "POST":
+                    for name in vpl.options.keys():
+                        vpl.options[name] = form.get(name, vpl.options[name])
+                return self.send(200, Page.execution_options(vpl, sesskey))
+            if url.path == "/mod/vpl/forms/executionkeepfiles.php":
+                vpl = course.vpls[int(form.get("id", query.get("id")))]
+                if method == "POST":
+                    vpl.keep = [f["name"] for i, f in enumerate(vpl.execution_files, start=4)
+                                if "keepfile%d" % i in form]
+                return self.send(200, Page.keep_files(vpl, sesskey))
+            if url.path in ("/mod/vpl/forms/executionfiles.json.php", "/mod/vpl/forms/requiredfiles.json.php"):
+                return self.json_files(url.path, query, body)
+        except (KeyError, ValueError) as e:
+            return self.send(404, Page.error("Registro não encontrado: " + str(e)))
+        return self.send(404, Page.error("Página não encontrada"))
+
+    def remote(self, path: str):
+        target = path.replace("/.cache/mapi.json", "")
+        if target not in self.moodle.remote:
+            return self.send(404, "404: Not Found", "text/plain")
+        text = self.moodle.remote[target]
+        etag = '"%08x"' % (hash(text) & 0xffffffff)
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send(200, text, "text/plain; charset=utf-8", {"ETag": etag})
+
+    def login(self, method: str, body: bytes):
+        settings = self.moodle.settings
+        if method == "GET":
+            return self.send(200, Page.login())
+        form = dict(urllib.parse.parse_qsl(body.decode("utf-8")))
+        if form.get("username") != settings.username or form.get("password") != settings.password:
+            return self.send(200, Page.login())
+        cookie, _sesskey = self.moodle.new_session()
+        self.redirect("/my/", {"Set-Cookie": "MoodleSession=%s; path=/" % cookie})
+
+    def modedit(self, method: str, query: Dict[str, str], form: Dict[str, str], sesskey: str):
+        course = self.moodle.course
+        if method == "GET":
+            if "update" in query:
+                vpl = course.vpls[int(query["update"])]
+                return self.send(200, Page.modedit(vpl, course, vpl.section, sesskey))
+            return self.send(200, Page.modedit(None, course, int(query.get("section", "0").strip()), sesskey))
+        if "sesskey" not in form:
+            return self.send(200, Page.error("invalidsesskey"))
+        if form.get("update", "0") != "0":
+            vpl = course.vpls[int(form["update"])]
+        else:
+            vpl = course.add_vpl(int(form["section"]), "")
+        vpl.title = form.get("name", "")
+        vpl.description = form.get("introeditor[text]", "")
+        vpl.maxfiles = form.get("maxfiles", "3")
+        if "duedate[enabled]" in form:
+            vpl.duedate = ":".join(form["duedate[" + key + "]"] for key in ("year", "month", "day", "hour", "minute"))
+        else:
+            vpl.duedate = "0"
+        self.redirect("/mod/vpl/view.php?id=%d" % vpl.id)
+
+    def delete(self, method: str, query: Dict[str, str], form: Dict[str, str], sesskey: str):
+        course = self.moodle.course
+        if method == "GET":
+            return self.send(200, Page.delete(course.vpls[int(query["delete"])], sesskey))
+        if form.get("confirm") != "1" or "sesskey" not in form:
+            return self.send(200, Page.error("invalidsesskey"))
+        with course.lock:
+            del course.vpls[int(form["delete"])]
+        self.redirect("/course/view.php?id=" + course.id)
+
+    def json_files(self, path: str, query: Dict[str, str], body: bytes):
+        vpl = self.moodle.course.vpls[int(query["id"])]
+        required = "requiredfiles" in path
+        if query.get("action") == "load":
+            files = vpl.required_files if required else vpl.execution_files
+            return self.send(200, json.dumps({"success": True, "response": {"files": files}}), "application/json")
+        data = json.loads(body.decode("utf-8"))
+        files = [{"name": f["name"], "contents": f["contents"], "encoding": f.get("encoding", 0)}
+                 for f in data["files"]]
+        if required:
+            vpl.required_files = files
+        else:
+            vpl.execution_files = files
+        self.send(200, json.dumps({"success": True, "response": {}}), "application/json")
+
+
+def make_server(moodle: FakeMoodle, port: int = 0) -> ThreadingHTTPServer:
+    handler = type("BoundHandler", (Handler,), {"moodle": moodle})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def start_in_background(moodle: FakeMoodle, port: int = 0) -> ThreadingHTTPServer:
+    server = make_server(moodle, port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="fake moodle server for mapi benchmarks")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--course", type=str, default="1")
+    parser.add_argument("--sections", type=int, default=10)
+    parser.add_argument("--vpls", type=int, default=0, help="number of vpls already in the course")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to each response")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="probability of 503 responses")
+    parser.add_argument("--no-session-lock", action="store_true", help="answer the requests of a session in parallel")
+    args = parser.parse_args()
+
+    course = FakeCourse(args.course, args.sections)
+    course.populate(args.vpls)
+    moodle = FakeMoodle(course, Settings(latency=args.latency, fail_rate=args.fail_rate,
+                                         session_lock=not args.no_session_lock))
+    server = make_server(moodle, args.port)
+    print("fake moodle on http://127.0.0.1:%d (user/pass)" % args.port)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Microbenchmark of the course page parser
+# Compares the single pass CoursePageParser with the former per section soup.select
+# Usage: python bench/parse_course.py [saved_course_page.html ...]
+# Without arguments synthetic course pages are generated
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import mapi  # noqa: E402
+from bs4 import BeautifulSoup  # noqa: E402
+
+
+def make_course_page(sections: int, activities: int) -> str:
+    parts = ['<!DOCTYPE html><html><head><title>Curso: Bench</title></head><body><ul class="topics">']
+    qid = 1000
+    for index in range(sections):
+        parts.append('<li id="section-%d" class="section main" aria-label="Tópico %d"><div class="content">'
+                     '<h3>Tópico %d</h3><div class="summary"><a href="https://m/mod/vpl/view.php?id=1">link</a></div>'
+                     '<ul class="section img-text">' % (index, index, index))
+        for i in range(activities):
+            qid += 1
+            kind = "vpl" if i % 5 != 0 else "forum"
+            parts.append('<li class="activity %s"><div><div class="mod-indent-outer"><div class="mod-indent"></div>'
+                         '<div><div class="activityinstance"><a href="https://m/mod/%s/view.php?id=%d">'
+                         '<span class="instancename">@%03d questão %d<span class="accesshide "> Laboratório Virtual '
+                         'de Programação</span></span></a></div><div class="contentafterlink">%s</div></div></div>'
+                         '</div></li>' % (kind, kind, qid, i, qid, "texto " * 40))
+        parts.append('</ul></div></li>')
+    parts.append('</ul></body></html>')
+    return "".join(parts)
+
+
+# parser used before the single pass version, kept here as the baseline
+def legacy_parse(text: str):
+    soup = BeautifulSoup(text, 'html.parser')
+    topics = soup.find('ul', {'class:', 'topics'})
+    output = []
+    for section_index, section in enumerate(topics.contents):
+        comp = ' > div.content > ul > li > div > div.mod-indent-outer > div > div.activityinstance > a'
+        entries = []
+        for activity in soup.select('#' + section['id'] + comp):
+            if not mapi.URLHandler.is_vpl_url(activity['href']):
+                continue
+            title = activity.get_text().replace(' Laboratório Virtual de Programação', '')
+            entries.append((int(mapi.URLHandler.parse_id(activity['href'])), title))
+        output.append(entries)
+    return [section['aria-label'] for section in topics.contents], output
+
+
+def single_pass_parse(text: str):
+    parser = mapi.CoursePageParser()
+    for start in range(0, len(text), 65536):  # same chunking used by MoodleAPI.stream_page
+        parser.feed(text[start:start + 65536])
+    parser.close()
+    items = [[(item.id, item.title) for item in section] for section in parser.section_item_list]
+    return parser.section_labels, items
+
+
+def best_of(function, text: str, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(text)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    pages = []
+    if len(sys.argv) > 1:
+        for path in sys.argv[1:]:
+            with open(path, encoding="utf-8") as f:
+                pages.append((os.path.basename(path), f.read()))
+    else:
+        for sections, activities in ((10, 10), (40, 10), (80, 20)):
+            pages.append(("%d sections x %d" % (sections, activities), make_course_page(sections, activities)))
+
+    print("%-22s %10s %12s %12s %8s" % ("page", "size", "legacy", "single", "speedup"))
+    for name, text in pages:
+        if legacy_parse(text) != single_pass_parse(text):
+            print(name + ": parsers disagree")
+            sys.exit(1)
+        legacy = best_of(legacy_parse, text, 3)
+        single = best_of(single_pass_parse, text, 3)
+        print("%-22s %9dK %11.1fms %11.1fms %7.1fx" % (name, len(text) // 1024, legacy * 1000, single * 1000,
+                                                        legacy / single))
+
+
+if __name__ == "__main__":
+    main()
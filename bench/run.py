@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Benchmark of the mapi commands against the local fake moodle
+# Runs list, add, update, down and rm on synthetic courses and reports wall time and requests/s
+# Usage: python bench/run.py [--sizes 10,100,1000] [--jobs 4] [--latency 0.05] [--fail-rate 0.0]
+#        python bench/run.py --save base.json     then, after a change,
+#        python bench/run.py --baseline base.json  fails when a command got slower than --tolerance
+
+from typing import Dict, List
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_moodle import FakeCourse, FakeMoodle, Settings, start_in_background  # noqa: E402
+
+MAPI = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "mapi.py")
+SECTIONS = 10
+
+
+def remote_question(label: str, version: int) -> str:
+    return json.dumps({"title": "@%s questão %s v%d" % (label, label, version),
+                       "description": "<p>descrição %s versão %d</p>" % (label, version),
+                       "upload": [{"name": "vpl_evaluate.cases", "contents": "case=\ninput=%d\noutput=%s\n"
+                                   % (version, label), "encoding": 0}],
+                       "keep": [{"name": "lib.h", "contents": "int f%s();" % label, "encoding": 0}],
+                       "required": [{"name": "lib.c", "contents": "int f%s() { return 0; }" % label,
+                                     "encoding": 0}]})
+
+
+class Bench:
+    def __init__(self, size: int, args):
+        self.size = size
+        self.args = args
+        course = FakeCourse("1", SECTIONS)
+        course.populate(size)
+        self.moodle = FakeMoodle(course, Settings(latency=args.latency, fail_rate=args.fail_rate))
+        self.labels = ["%03d" % (i + 1) for i in range(size)]  # already in the course
+        self.new_labels = ["%d" % (10000 + i) for i in range(size)]  # sent by add
+        for label in self.labels:
+            self.moodle.remote[label] = remote_question(label, 2)
+        for label in self.new_labels:
+            self.moodle.remote[label] = remote_question(label, 1)
+        self.server = start_in_background(self.moodle)
+        self.folder = tempfile.TemporaryDirectory(prefix="mapi_bench_")
+        self.config = os.path.join(self.folder.name, "config.json")
+        url = "http://127.0.0.1:%d" % self.server.server_address[1]
+        with open(self.config, "w") as f:
+            json.dump({"username": "user", "password": "pass", "url": url, "course": "1",
+                       "remote": url + "/remote"}, f)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.folder.cleanup()
+
+    def mapi(self, name: str, command: List[str]) -> Dict[str, float]:
+        rate = [] if self.args.max_rate is None else ["--max-rate", str(self.args.max_rate)]
+        argv = [sys.executable, MAPI, "-c", self.config] + rate + command
+        self.moodle.reset_counter()
+        start = time.perf_counter()
+        result = subprocess.run(argv, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+        wall = time.perf_counter() - start
+        if result.returncode != 0 or "FAIL" in result.stdout:
+            print(result.stdout[-2000:])
+            raise RuntimeError("mapi " + name + " failed on " + str(self.size) + " vpls")
+        requests = self.moodle.total_requests()
+        return {"wall": wall, "requests": requests, "rps": requests / wall}
+
+    def run(self) -> Dict[str, Dict[str, float]]:
+        jobs = ["-j", str(self.args.jobs)]
+        output_dir = os.path.join(self.folder.name, "down")
+        os.mkdir(output_dir)
+        commands = [
+            ("list", ["-r", "list"]),
+            ("add", ["add"] + self.new_labels + ["-s", "1"] + jobs),
+            ("update", ["update", "--all", "-c"] + jobs),
+            ("down", ["down", "--all", "-o", output_dir] + jobs),
+            ("rm", ["rm", "--all"]),
+        ]
+        results = {}
+        for name, command in commands:
+            results[name] = self.mapi(name, command)
+            print("%6d %-8s %9.2fs %9d %9.1f" % (self.size, name, results[name]["wall"], results[name]["requests"],
+                                                  results[name]["rps"]), flush=True)
+        if self.moodle.course.vpls:
+            raise RuntimeError("rm left %d vpls in the course" % len(self.moodle.course.vpls))
+        return results
+
+
+def compare(results: Dict[str, Dict], baseline_path: str, tolerance: float) -> bool:
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    ok = True
+    for size, commands in results.items():
+        for name, result in commands.items():
+            before = baseline.get(size, {}).get(name)
+            if before is None:
+                continue
+            ratio = result["wall"] / before["wall"]
+            if ratio > tolerance:
+                print("regression: %s on %s vpls took %.2fs, %.2fx the baseline" % (name, size, result["wall"], ratio))
+                ok = False
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark mapi commands against the fake moodle")
+    parser.add_argument("--sizes", type=str, default="10,100,1000", help="comma separated number of vpls")
+    parser.add_argument("--jobs", type=int, default=4, help="value passed to -j")
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds added to each response")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="probability of 503 responses")
+    parser.add_argument("--max-rate", type=float, help="value passed to --max-rate, none by default")
+    parser.add_argument("--save", type=str, help="save the results to this json file")
+    parser.add_argument("--baseline", type=str, help="compare the wall times with a saved json file")
+    parser.add_argument("--tolerance", type=float, default=1.25, help="max wall time ratio to the baseline")
+    args = parser.parse_args()
+
+    print("%6s %-8s %10s %9s %9s" % ("vpls", "command", "wall", "requests", "req/s"))
+    results = {}
+    for size in [int(value) for value in args.sizes.split(",")]:
+        bench = Bench(size, args)
+        try:
+            results[str(size)] = bench.run()
+        finally:
+            bench.close()
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline and not compare(results, args.baseline, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
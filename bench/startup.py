@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Cold start check of the commands that do not touch the network
+# Runs mapi with -X importtime and fails when a heavy module is imported
+# or when the best wall time of the runs exceeds --max-ms
+# Usage: python bench/startup.py [--runs 5] [--max-ms 250]
+
+from typing import List, Tuple
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+MAPI = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "mapi.py")
+HEAVY = ["requests", "mechanicalsoup", "bs4", "urllib3", "sqlite3", "urllib.request"]
+
+
+def commands(config: str) -> List[Tuple[str, List[str]]]:
+    return [
+        ("help", ["-h"]),
+        ("setup help", ["setup", "-h"]),
+        ("add help", ["add", "-h"]),
+        ("bad argument", ["--no-such-option"]),
+        ("setup", ["-c", config, "setup", "--url", "http://127.0.0.1:1", "--course", "1", "--username", "user"]),
+    ]
+
+
+def imported_modules(argv: List[str]) -> List[str]:
+    result = subprocess.run([sys.executable, "-X", "importtime", MAPI] + argv,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    modules = []
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            modules.append(line.split("|")[-1].strip())
+    return modules
+
+
+def best_wall(argv: List[str], runs: int) -> float:
+    best = float("inf")
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, MAPI] + argv, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="cold start check of the non network mapi commands")
+    parser.add_argument("--runs", type=int, default=5, help="runs of each command, the best one is used")
+    parser.add_argument("--max-ms", type=float, default=250.0, help="max wall time of each command")
+    args = parser.parse_args()
+
+    baseline = best_wall_python(args.runs)
+    print("%-14s %10s   %s" % ("command", "wall", "heavy modules"))
+    print("%-14s %8.1fms" % ("python -c ''", baseline * 1000))
+    ok = True
+    with tempfile.TemporaryDirectory(prefix="mapi_startup_") as folder:
+        config = os.path.join(folder, "config.json")
+        for name, argv in commands(config):
+            heavy = [module for module in imported_modules(argv) if module in HEAVY]
+            wall = best_wall(argv, args.runs)
+            print("%-14s %8.1fms   %s" % (name, wall * 1000, ", ".join(heavy) if heavy else "-"))
+            if heavy:
+                print("regression: " + name + " imports " + ", ".join(heavy))
+                ok = False
+            if wall * 1000 > args.max_ms:
+                print("regression: %s took %.1fms, more than %.1fms" % (name, wall * 1000, args.max_ms))
+                ok = False
+    if not ok:
+        sys.exit(1)
+
+
+def best_wall_python(runs: int) -> float:
+    best = float("inf")
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", ""])
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+if __name__ == "__main__":
+    main()
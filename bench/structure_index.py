@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Scaling check of the Structure indexes
+# Selects half of the items by label, as "update/rm -l" do, then removes them
+# The time per item should stay flat when the course grows
+# Usage: python bench/structure_index.py
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import mapi  # noqa: E402
+
+
+def make_structure(sections: int, items: int) -> mapi.Structure:
+    section_item_list = [[] for _ in range(sections)]
+    for i in range(items):
+        section = i % sections
+        section_item_list[section].append(mapi.StructureItem(section, 1000 + i, "@%05d questão %d" % (i, i)))
+    return mapi.Structure(section_item_list, ["Tópico %d" % i for i in range(sections)])
+
+
+def run(items: int) -> float:
+    structure = make_structure(50, items)
+    labels = ["%05d" % i for i in range(0, items, 2)]
+    start = time.perf_counter()
+    selected = mapi.Update.load_itens(False, None, None, labels, structure)
+    for item in selected:
+        if not structure.has_id(item.id, item.section):
+            raise AssertionError("missing id %d" % item.id)
+        structure.rm_item(item.id)
+    elapsed = time.perf_counter() - start
+    if len(selected) != len(labels) or len(structure.get_id_list()) != items - len(labels):
+        raise AssertionError("wrong selection for %d items" % items)
+    if structure.search_by_label(labels[0]) != [] or len(structure.search_by_label("%05d" % 1)) != 1:
+        raise AssertionError("label index out of sync")
+    return elapsed
+
+
+def main():
+    print("%8s %12s %16s" % ("items", "total", "per item"))
+    per_item = []
+    for items in (1000, 10000, 100000):
+        elapsed = run(items)
+        per_item.append(elapsed / (items // 2))
+        print("%8d %10.1fms %14.2fus" % (items, elapsed * 1000, per_item[-1] * 1e6))
+    # a quadratic selection would grow 100x between the first and the last size
+    if per_item[-1] > per_item[0] * 10:
+        print("selection is not linear")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
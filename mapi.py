@@ -1,21 +1,57 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from typing import List, Optional, Any, Dict
-import mechanicalsoup
+from typing import List, Optional, Any, Dict, Tuple, Iterator, Iterable, Callable
+import importlib
 import json
 import os
 import argparse
 import sys
 import getpass  # get pass
 import pathlib
-import requests
-import urllib.request
-import urllib.error
-import tempfile
+import hashlib
+import threading
+import time
+import concurrent.futures
+import contextlib
+import contextvars
+import html.parser
+import collections
+import itertools
+import random
+import math
+import atexit
+import urllib.parse
+import html
+import re
+import base64
+import codecs
+import socket
+import traceback
 from enum import Enum
 
 
+# module imported on its first attribute access, so help, setup, argument errors and the
+# commands answered from the cache start without loading the http and html libraries
+# the import lock makes the first access safe when it happens in several workers at once
+class LazyModule:
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr: str):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+mechanicalsoup = LazyModule("mechanicalsoup")
+requests = LazyModule("requests")
+sqlite3 = LazyModule("sqlite3")
+subprocess = LazyModule("subprocess")
+shutil = LazyModule("shutil")
+
+
 class SourceMode(Enum):
     LOCAL = 0
     REMOTE = 1
@@ -28,8 +64,9 @@ class MergeMode(Enum):
 
 
 class URLHandler:
-    def __init__(self):
-        credentials: Credentials = Credentials.load_credentials()
+    def __init__(self, credentials: Optional['Credentials'] = None):
+        if credentials is None:
+            credentials = Credentials.load_credentials()
         self._url_base: str = credentials.url
         self.course_id: str = credentials.course
 
@@ -42,6 +79,9 @@ class URLHandler:
     def course(self):
         return self._url_base + "/course/view.php?id=" + self.course_id
 
+    def course_section(self, section: int):
+        return self.course() + "&section=" + str(section)
+
     def login(self):
         return self._url_base + '/login/index.php'
 
@@ -76,6 +116,12 @@ class URLHandler:
     def required_files(self, qid: int):
         return self._url_base + '/mod/vpl/forms/requiredfiles.json.php?id=' + str(qid) + '&action=save'
 
+    def load_execution_files(self, qid: int):
+        return self._url_base + '/mod/vpl/forms/executionfiles.json.php?id=' + str(qid) + '&action=load'
+
+    def load_required_files(self, qid: int):
+        return self._url_base + '/mod/vpl/forms/requiredfiles.json.php?id=' + str(qid) + '&action=load'
+
     def execution_options(self, qid: int):
         return self._url_base + "/mod/vpl/forms/executionoptions.php?id=" + str(qid)
 
@@ -95,6 +141,8 @@ class URLHandler:
 class Credentials:
     config_path = None
     instance = None
+    # course of the current thread in a fan-out, instance otherwise; copied to the worker threads
+    active: contextvars.ContextVar = contextvars.ContextVar("credentials", default=None)
 
     def __init__(self, username: str, password: str, url: str, course: str, remote: str):
         self.username = username
@@ -107,6 +155,15 @@ class Credentials:
     def load_default_config_path():
         return str(pathlib.Path.home()) + os.sep + '.mapirc'
 
+    # folder beside the config file used to store sessions and caches
+    @staticmethod
+    def cache_dir() -> str:
+        if Credentials.config_path is None:
+            Credentials.config_path = Credentials.load_default_config_path()
+        path = os.path.join(os.path.dirname(os.path.abspath(Credentials.config_path)), '.mapi_cache')
+        os.makedirs(path, exist_ok=True)
+        return path
+
     @staticmethod
     def load_file(path):
         config = {}
@@ -153,37 +210,182 @@ class Credentials:
 
     @staticmethod
     def load_credentials():
+        active = Credentials.active.get()
+        if active is not None:
+            return active
         if Credentials.instance is not None:
             return Credentials.instance
         if Credentials.config_path is None:
             Credentials.config_path = Credentials.load_default_config_path()
-        Credentials.instance = Credentials.load_file(Credentials.config_path)
-        if Credentials.instance.password is None:
-            print("Digite sua senha:")
-            Credentials.instance.password = getpass.getpass()
+        Credentials.instance = Credentials.from_config(Credentials.config_path)
         return Credentials.instance
 
+    # asks the password when the config file does not have it
+    @staticmethod
+    def from_config(path: str) -> 'Credentials':
+        credentials = Credentials.load_file(path)
+        if credentials.password is None:
+            print("Digite sua senha" + ("" if path == Credentials.config_path else " para " + path) + ":")
+            credentials.password = getpass.getpass()
+        return credentials
+
     def __str__(self):
         return self.username + ":" + self.password + ":" + self.url + ":" + self.course
 
 
+# large contents of the loaded vpls, kept on disk until a stage sends them
+# files are named by sha256 inside a folder of .mapi_cache removed at the end of the run
+class ContentStore:
+    inline_max: int = 16 * 1024  # smaller contents stay in memory
+    _folder: Optional[str] = None
+    _registered: bool = False
+    _lock = threading.Lock()
+
+    @staticmethod
+    def put(data: bytes) -> str:
+        with ContentStore._lock:
+            if ContentStore._folder is None:
+                ContentStore._folder = os.path.join(Credentials.cache_dir(), "contents_" + str(os.getpid()))
+                os.makedirs(ContentStore._folder, exist_ok=True)
+                if not ContentStore._registered:
+                    atexit.register(ContentStore.clear)
+                    ContentStore._registered = True
+            path = os.path.join(ContentStore._folder, hashlib.sha256(data).hexdigest())
+        if not os.path.isfile(path):
+            with open(path + "." + str(threading.get_ident()) + ".tmp", "wb") as f:
+                f.write(data)
+            os.replace(path + "." + str(threading.get_ident()) + ".tmp", path)
+        return path
+
+    @staticmethod
+    def owns(path: Optional[str]) -> bool:
+        return path is not None and ContentStore._folder is not None and os.path.dirname(path) == ContentStore._folder
+
+    @staticmethod
+    def clear():
+        with ContentStore._lock:
+            if ContentStore._folder is not None:
+                shutil.rmtree(ContentStore._folder, ignore_errors=True)
+                ContentStore._folder = None
+
+    # file of a loaded json, moved to the store when large
+    @staticmethod
+    def file(name: str, contents: str, encoding: int, path: Optional[str]) -> 'JsonFile':
+        if path is not None or len(contents) <= ContentStore.inline_max:
+            return JsonFile(name, contents, encoding, path)
+        data = base64.b64decode(contents) if encoding == 1 else contents.encode("utf-8")
+        return JsonFile(name, "", encoding, ContentStore.put(data))
+
+
 # Format used to send additional files to VPL
+# files read from disk keep only the path and are read again when sent, binary ones as base64 (encoding 1)
 class JsonFile:
-    def __init__(self, name: str, contents: str):
+    __slots__ = ("name", "contents", "encoding", "path")
+    chunk_size: int = 3 * 64 * 1024  # multiple of 3, so the base64 of the chunks can be joined
+
+    def __init__(self, name: str, contents: str, encoding: int = 0, path: Optional[str] = None):
         self.name: str = name
         self.contents: str = contents
-        self.encoding: int = 0
+        self.encoding: int = encoding
+        self.path: Optional[str] = path
+
+    @staticmethod
+    def from_path(name: str, path: str) -> 'JsonFile':
+        return JsonFile(name, "", 0 if JsonFile.is_text(path) else 1, path)
+
+    # utf-8 without nul bytes, checked in chunks
+    @staticmethod
+    def is_text(path: str) -> bool:
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        try:
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(JsonFile.chunk_size), b""):
+                    if b"\0" in chunk:
+                        return False
+                    decoder.decode(chunk)
+            decoder.decode(b"", final=True)
+        except UnicodeDecodeError:
+            return False
+        return True
+
+    # pieces of the contents as they go in the json
+    def chunks(self) -> Iterator[str]:
+        if self.path is None:
+            yield self.contents
+            return
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        with open(self.path, "rb") as f:
+            for chunk in iter(lambda: f.read(JsonFile.chunk_size), b""):
+                yield base64.b64encode(chunk).decode("ascii") if self.encoding == 1 else decoder.decode(chunk)
+        if self.encoding != 1:
+            yield decoder.decode(b"", final=True)
+
+    def read(self) -> str:
+        return "".join(self.chunks())
+
+    # files of the ContentStore are written with their contents, they are gone after the run
+    def to_dict(self) -> Dict[str, Any]:
+        if self.path is not None and not ContentStore.owns(self.path):
+            return {"name": self.name, "path": self.path, "encoding": self.encoding}
+        return {"name": self.name, "contents": self.read(), "encoding": self.encoding}
+
+    # same as to_dict for the files in memory, files on disk are hashed without loading them
+    def fingerprint(self) -> Dict[str, Any]:
+        if self.path is None:
+            return {"name": self.name, "contents": self.contents, "encoding": self.encoding}
+        digest = hashlib.sha256()
+        for chunk in self.chunks():
+            digest.update(chunk.encode())
+        return {"name": self.name, "sha256": digest.hexdigest(), "encoding": self.encoding}
 
     def __str__(self):
-        return self.name + ":" + self.contents + ":" + str(self.encoding)
+        return self.name + ":" + self.read() + ":" + str(self.encoding)
+
+
+# body of the file endpoints, {"files": [...], "comments": ""} as compact json
+# written while it is sent, so a file is never whole in memory; the length is counted in a first pass
+class FilesPayload:
+    block_size: int = 64 * 1024
+
+    def __init__(self, files: List[JsonFile]):
+        self.files = files
+        self._length: Optional[int] = None
+
+    # ascii only, json.dumps escapes the rest
+    def pieces(self) -> Iterator[str]:
+        yield '{"files":['
+        for index, file in enumerate(self.files):
+            yield ('{"name":' if index == 0 else ',{"name":') + json.dumps(file.name) + ',"contents":"'
+            for chunk in file.chunks():
+                yield json.dumps(chunk)[1:-1]
+            yield '","encoding":' + str(file.encoding) + '}'
+        yield '],"comments":""}'
+
+    def __iter__(self) -> Iterator[bytes]:
+        block: List[str] = []
+        size = 0
+        for piece in self.pieces():
+            block.append(piece)
+            size += len(piece)
+            if size >= FilesPayload.block_size:
+                yield "".join(block).encode("ascii")
+                block, size = [], 0
+        if size > 0:
+            yield "".join(block).encode("ascii")
+
+    def __len__(self) -> int:
+        if self._length is None:
+            self._length = sum(len(piece) for piece in self.pieces())
+        return self._length
 
 
 class JsonVPL:
+    __slots__ = ("title", "_description", "_description_path", "upload", "required", "keep")
     test_cases_file_name = "vpl_evaluate.cases"
 
     def __init__(self, title: str, description: str, tests: Optional[str] = None):
         self.title: str = title
-        self.description: str = description
+        self.description = description
         self.upload: List[JsonFile] = []
         self.required: List[JsonFile] = []
         self.keep: List[JsonFile] = []
@@ -191,72 +393,774 @@ class JsonVPL:
         if tests is not None:
             self.set_test_cases(tests)
 
+    # a large description goes to the ContentStore and is read when the form is sent
+    @property
+    def description(self) -> str:
+        if self._description_path is None:
+            return self._description
+        with open(self._description_path, encoding="utf-8") as f:
+            return f.read()
+
+    @description.setter
+    def description(self, description: str):
+        self._description_path = None
+        self._description = description
+        if len(description) > ContentStore.inline_max:
+            self._description_path = ContentStore.put(description.encode("utf-8"))
+            self._description = ""
+
     def set_test_cases(self, tests: str):
         file = next((file for file in self.upload if file.name == JsonVPL.test_cases_file_name), None)
         if file is not None:
-            file.contents = tests
+            file.contents, file.encoding, file.path = tests, 0, None
             return
         self.upload.append(JsonFile("vpl_evaluate.cases", tests))
 
+    def to_dict(self) -> Dict[str, Any]:
+        return {"title": self.title, "description": self.description, "upload": self.upload,
+                "required": self.required, "keep": self.keep}
+
     def to_json(self) -> str:
-        return json.dumps(self, default=lambda o: o.__dict__, indent=4)
+        return json.dumps(self, default=lambda o: o.to_dict(), indent=4)
+
+    # one hash for each stage of the upload, so only the changed stages are sent again
+    # keep depends on the execution file names, since moodle marks the kept files by position
+    def fingerprints(self, duedate: Optional[str]) -> Dict[str, str]:
+        def digest(data) -> str:
+            return hashlib.sha256(json.dumps(data, default=JsonFile.fingerprint).encode()).hexdigest()
+        execution_files = self.keep + self.upload
+        return {
+            "info": digest([self.title, self.description, duedate, max(len(self.keep), 3)]),
+            "exec_options": digest(MoodleAPI.execution_options),
+            "exec_files": digest(execution_files),
+            "required_files": digest(self.required),
+            "keep": digest([len(self.keep), [file.name for file in execution_files]]),
+        }
 
     def __str__(self):
         return self.to_json()
 
 
+# local cache of remote files in .mapi_cache/remote
+# each url keeps its etag/last-modified to send conditional requests
+# contents are stored once by sha256 and the least recently used urls are evicted above max_bytes
+class RemoteCache:
+    max_bytes: int = 64 * 1024 * 1024
+    offline: bool = False
+    _index: Optional[Dict[str, Dict[str, Any]]] = None
+    _lock = threading.RLock()
+    _session: Optional['requests.Session'] = None
+
+    # one pooled http session shared by the prefetch threads
+    @staticmethod
+    def _http() -> 'requests.Session':
+        with RemoteCache._lock:
+            if RemoteCache._session is None:
+                RemoteCache._session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_maxsize=16)
+                RemoteCache._session.mount("http://", adapter)
+                RemoteCache._session.mount("https://", adapter)
+            return RemoteCache._session
+
+    @staticmethod
+    def _dir() -> str:
+        path = os.path.join(Credentials.cache_dir(), "remote")
+        os.makedirs(os.path.join(path, "blobs"), exist_ok=True)
+        return path
+
+    @staticmethod
+    def _blob_path(digest: str) -> str:
+        return os.path.join(RemoteCache._dir(), "blobs", digest)
+
+    @staticmethod
+    def _entries() -> Dict[str, Dict[str, Any]]:
+        if RemoteCache._index is None:
+            try:
+                with open(os.path.join(RemoteCache._dir(), "index.json")) as f:
+                    RemoteCache._index = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                RemoteCache._index = {}
+        return RemoteCache._index
+
+    @staticmethod
+    def _save_entries():
+        path = os.path.join(RemoteCache._dir(), "index.json")
+        with open(path + ".tmp", "w") as f:
+            f.write(json.dumps(RemoteCache._entries()))
+        os.replace(path + ".tmp", path)
+
+    @staticmethod
+    def _read_blob(entry: Optional[Dict[str, Any]]) -> Optional[bytes]:
+        if entry is None:
+            return None
+        try:
+            with open(RemoteCache._blob_path(entry["digest"]), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    # returns the content and how it was obtained: download, not modified, cached
+    @staticmethod
+    def get(url: str) -> Tuple[Optional[bytes], str]:
+        with RemoteCache._lock:
+            entry = RemoteCache._entries().get(url)
+            cached = RemoteCache._read_blob(entry)
+        if cached is None:
+            entry = None
+        if RemoteCache.offline:
+            if cached is None:
+                return None, "not in cache"
+            RemoteCache._touch(url)
+            return cached, "cached"
+
+        headers = {}
+        if entry is not None and entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry is not None and entry.get("modified"):
+            headers["If-Modified-Since"] = entry["modified"]
+        timeout = MoodleAPI.default_timeout if MoodleAPI.default_timeout != 0 else None
+        try:
+            response = RemoteCache._http().get(url, headers=headers, timeout=timeout)
+        except requests.RequestException as e:
+            if cached is not None:  # network down, the last copy is better than nothing
+                RemoteCache._touch(url)
+                return cached, "cached"
+            return None, str(e)
+        if response.status_code == 304 and cached is not None:
+            RemoteCache._touch(url)
+            return cached, "not modified"
+        if response.status_code != 200:
+            return None, "HTTP " + str(response.status_code)
+        RemoteCache._store(url, response.content, response.headers.get("ETag"), response.headers.get("Last-Modified"))
+        return response.content, "download"
+
+    @staticmethod
+    def _touch(url: str):
+        with RemoteCache._lock:
+            RemoteCache._entries()[url]["used"] = time.time()
+            RemoteCache._save_entries()
+
+    @staticmethod
+    def _store(url: str, data: bytes, etag: Optional[str], modified: Optional[str]):
+        digest = hashlib.sha256(data).hexdigest()
+        with RemoteCache._lock:
+            path = RemoteCache._blob_path(digest)
+            if not os.path.isfile(path):
+                with open(path + ".tmp", "wb") as f:
+                    f.write(data)
+                os.replace(path + ".tmp", path)
+            RemoteCache._entries()[url] = {"digest": digest, "size": len(data), "etag": etag, "modified": modified,
+                                           "used": time.time()}
+            RemoteCache._evict()
+            RemoteCache._save_entries()
+
+    @staticmethod
+    def _evict():
+        entries = RemoteCache._entries()
+        sizes = {entry["digest"]: entry["size"] for entry in entries.values()}
+        total = sum(sizes.values())
+        for url, entry in sorted(entries.items(), key=lambda pair: pair[1]["used"]):
+            if total <= RemoteCache.max_bytes:
+                break
+            del entries[url]
+            if all(other["digest"] != entry["digest"] for other in entries.values()):
+                total -= entry["size"]
+                try:
+                    os.remove(RemoteCache._blob_path(entry["digest"]))
+                except FileNotFoundError:
+                    pass
+
+
+# builds a JsonVPL from a local question folder described by mapicfg.json or .mapi.json
+# {"markdown": "Readme.md", "tests": "t.vpl", "upload": [...], "keep": [...], "required": [...]}
+# the markdown becomes the description, with pandoc when installed, and the .tio/.vpl tests become the cases
+# without "tests", the .tio/.vpl files of the folder are used, or the tio blocks of the markdown
+# each build is kept in .mapi_cache/build with the mtime, size and sha256 of its inputs
+class LocalBuilder:
+    config_names = ["mapicfg.json", ".mapi.json"]
+    jobs: int = os.cpu_count() or 4
+    _built: Dict[str, JsonVPL] = {}  # by build_all, consumed by load
+    _lock = threading.Lock()
+    _pandoc: Any = False  # path of pandoc, None when missing, False before looking for it
+    tio_case = re.compile(r">>>>>>>>[^\n]*\n(.*?)^========[^\n]*\n(.*?)^<<<<<<<<", re.DOTALL | re.MULTILINE)
+
+    # only targets written as paths are local: a bare label like 002 is remote even beside a 002 folder
+    @staticmethod
+    def is_local(target: str) -> bool:
+        if target.endswith(".json"):
+            return os.path.isfile(target)
+        return ("/" in target or os.sep in target) and os.path.isdir(target)
+
+    @staticmethod
+    def pandoc() -> Optional[str]:
+        if LocalBuilder._pandoc is False:
+            LocalBuilder._pandoc = shutil.which("pandoc")
+        return LocalBuilder._pandoc
+
+    # returns the vpl and how it was obtained: built, cached, file
+    @staticmethod
+    def load(target: str) -> Tuple[JsonVPL, str]:
+        if os.path.isfile(target):
+            with open(target, encoding="utf-8") as f:
+                return JsonVplLoader._load_from_string(f.read()), "file"
+        folder = os.path.abspath(target)
+        with LocalBuilder._lock:
+            built = LocalBuilder._built.pop(folder, None)
+        if built is not None:
+            return built, "built"
+        config = LocalBuilder._config(folder)
+        inputs = LocalBuilder._inputs(folder, config)
+        vpl = LocalBuilder._cached(folder, inputs)
+        if vpl is not None:
+            return vpl, "cached"
+        vpl = LocalBuilder._build(folder, config)
+        LocalBuilder._save(folder, inputs, vpl)
+        return vpl, "built"
+
+    # builds the local folders of the targets in parallel before they are sent
+    @staticmethod
+    def build_all(targets: List[str]):
+        folders = [os.path.abspath(target) for target in targets
+                   if LocalBuilder.is_local(target) and os.path.isdir(target)]
+        if len(folders) < 2:
+            return
+        start = time.time()
+
+        def build(folder: str) -> str:
+            try:
+                vpl, status = LocalBuilder.load(folder)
+            except (OSError, ValueError, KeyError):
+                return "fail"  # reported when the target is loaded
+            with LocalBuilder._lock:
+                LocalBuilder._built[folder] = vpl
+            return status
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(LocalBuilder.jobs, 1)) as pool:
+            status = list(pool.map(build, folders))
+        print("- Building {} local questions: {} built, {} cached, {} failed in {:.1f}s".format(
+            len(folders), status.count("built"), status.count("cached"), status.count("fail"), time.time() - start))
+
+    @staticmethod
+    def _config(folder: str) -> Dict[str, Any]:
+        config: Dict[str, Any] = {"markdown": "Readme.md", "upload": [], "keep": [], "required": []}
+        for name in LocalBuilder.config_names:
+            path = os.path.join(folder, name)
+            if os.path.isfile(path):
+                with open(path, encoding="utf-8") as f:
+                    config.update(json.load(f))
+                config["file"] = name
+                break
+        if isinstance(config.get("tests"), str):
+            config["tests"] = [config["tests"]]
+        if "tests" not in config:
+            config["tests"] = sorted(name for name in os.listdir(folder)
+                                     if name.endswith(".tio") or name.endswith(".vpl"))
+        return config
+
+    # names of the files read by the build, relative to the folder
+    @staticmethod
+    def _inputs(folder: str, config: Dict[str, Any]) -> List[str]:
+        names = [config["markdown"]] + config["tests"] + config["upload"] + config["keep"] + config["required"]
+        if "file" in config:
+            names.append(config["file"])
+        return sorted(set(name for name in names if os.path.isfile(os.path.join(folder, name))))
+
+    @staticmethod
+    def _digest(path: str) -> str:
+        with open(path, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+
+    @staticmethod
+    def _cache_path(folder: str) -> str:
+        path = os.path.join(Credentials.cache_dir(), "build")
+        os.makedirs(path, exist_ok=True)
+        return os.path.join(path, hashlib.sha1(folder.encode()).hexdigest()[:16] + ".json")
+
+    # the build is reused when no input changed, an input with a new mtime but the same hash still counts
+    @staticmethod
+    def _cached(folder: str, inputs: List[str]) -> Optional[JsonVPL]:
+        try:
+            with open(LocalBuilder._cache_path(folder)) as f:
+                entry = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        if entry.get("folder") != folder or entry.get("pandoc") != (LocalBuilder.pandoc() is not None):
+            return None
+        if sorted(entry["inputs"].keys()) != inputs:
+            return None
+        for name, (mtime, size, digest) in entry["inputs"].items():
+            stat = os.stat(os.path.join(folder, name))
+            if stat.st_mtime_ns == mtime and stat.st_size == size:
+                continue
+            if stat.st_size != size or LocalBuilder._digest(os.path.join(folder, name)) != digest:
+                return None
+        return JsonVplLoader._load_from_string(entry["vpl"], trusted=True)
+
+    @staticmethod
+    def _save(folder: str, inputs: List[str], vpl: JsonVPL):
+        stamps = {}
+        for name in inputs:
+            path = os.path.join(folder, name)
+            stat = os.stat(path)
+            stamps[name] = [stat.st_mtime_ns, stat.st_size, LocalBuilder._digest(path)]
+        entry = {"folder": folder, "pandoc": LocalBuilder.pandoc() is not None, "inputs": stamps,
+                 "vpl": vpl.to_json()}
+        path = LocalBuilder._cache_path(folder)
+        with open(path + "." + str(threading.get_ident()) + ".tmp", "w") as f:
+            f.write(json.dumps(entry))
+        os.replace(path + "." + str(threading.get_ident()) + ".tmp", path)
+
+    @staticmethod
+    def _read(folder: str, name: str) -> str:
+        with open(os.path.join(folder, name), encoding="utf-8") as f:
+            return f.read()
+
+    @staticmethod
+    def _build(folder: str, config: Dict[str, Any]) -> JsonVPL:
+        markdown = ""
+        if os.path.isfile(os.path.join(folder, config["markdown"])):
+            markdown = LocalBuilder._read(folder, config["markdown"])
+        title = next((line.strip("# \t") for line in markdown.splitlines() if line.strip() != ""),
+                     os.path.basename(folder))
+        cases = []
+        for name in config["tests"]:
+            text = LocalBuilder._read(folder, name)
+            cases.append(LocalBuilder.tio_to_vpl(text) if name.endswith(".tio") else text)
+        if len(config["tests"]) == 0:
+            cases.append(LocalBuilder.tio_to_vpl(markdown))
+        vpl = JsonVPL(title, LocalBuilder.to_html(markdown, folder), "\n".join(case for case in cases if case != ""))
+        for kind in ("upload", "keep", "required"):
+            for name in config[kind]:
+                getattr(vpl, kind).append(JsonFile.from_path(name, os.path.join(folder, name)))
+        return vpl
+
+    # >>>>>>>> input ======== output <<<<<<<< blocks to vpl_evaluate.cases
+    @staticmethod
+    def tio_to_vpl(text: str) -> str:
+        cases = []
+        for case_input, case_output in LocalBuilder.tio_case.findall(text):
+            cases.append("case=\ninput=" + case_input + "output=\"" + case_output + "\"\ngrade reduction=100%\n")
+        return "\n".join(cases)
+
+    @staticmethod
+    def to_html(markdown: str, folder: str) -> str:
+        pandoc = LocalBuilder.pandoc()
+        if pandoc is not None:
+            result = subprocess.run([pandoc, "-f", "gfm", "-t", "html"], input=markdown, cwd=folder,
+                                    stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+            if result.returncode == 0:
+                return result.stdout
+        return LocalBuilder._simple_html(markdown)
+
+    # headings, code blocks and paragraphs, used when pandoc is not installed
+    @staticmethod
+    def _simple_html(markdown: str) -> str:
+        output: List[str] = []
+        paragraph: List[str] = []
+        code: Optional[List[str]] = None
+
+        def end_paragraph():
+            if len(paragraph) > 0:
+                output.append("<p>" + html.escape(" ".join(paragraph)) + "</p>")
+                paragraph.clear()
+
+        for line in markdown.splitlines():
+            if line.startswith("```"):
+                if code is None:
+                    end_paragraph()
+                    code = []
+                else:
+                    output.append("<pre><code>" + html.escape("\n".join(code) + "\n") + "</code></pre>")
+                    code = None
+            elif code is not None:
+                code.append(line)
+            elif line.startswith("#"):
+                end_paragraph()
+                level = min(len(line) - len(line.lstrip("#")), 6)
+                output.append("<h{0}>{1}</h{0}>".format(level, html.escape(line.strip("# \t"))))
+            elif line.strip() == "":
+                end_paragraph()
+            else:
+                paragraph.append(line.strip())
+        end_paragraph()
+        if code is not None:
+            output.append("<pre><code>" + html.escape("\n".join(code) + "\n") + "</code></pre>")
+        return "\n".join(output) + "\n"
+
+
 class JsonVplLoader:
+    # set by FanOut: each vpl is loaded once and shared by the courses, key -> future of the vpl
+    shared: Optional[Dict[str, concurrent.futures.Future]] = None
+    _lock = threading.Lock()
+
+    # the paths of the files are read only from trusted json, the build cache written by LocalBuilder
+    # other json, like the remote ones, could point to any local file and have it sent to moodle
     @staticmethod
-    def _load_from_string(text: str) -> JsonVPL:
+    def _load_from_string(text: str, trusted: bool = False) -> JsonVPL:
         data = json.loads(text)
         vpl = JsonVPL(data["title"], data["description"])
-        for f in data["upload"]:
-            vpl.upload.append(JsonFile(f["name"], f["contents"]))
-        for f in data["keep"]:
-            vpl.keep.append(JsonFile(f["name"], f["contents"]))
-        for f in data["required"]:
-            vpl.required.append(JsonFile(f["name"], f["contents"]))
+        for kind in ("upload", "keep", "required"):
+            for f in data[kind]:
+                path = f.get("path") if trusted else None
+                getattr(vpl, kind).append(ContentStore.file(f["name"], f.get("contents", ""),
+                                                            int(f.get("encoding", 0)), path))
         return vpl
 
     @staticmethod
-    def save_as(file_url, filename) -> bool:
+    def _remote_url(target: str) -> str:
+        return os.path.join(Credentials.load_credentials().remote, target + "/.cache/mapi.json")
+
+    @staticmethod
+    def load(target: str, source_mode: SourceMode) -> JsonVPL:
+        if JsonVplLoader.shared is None:
+            return JsonVplLoader._load(target, source_mode)
+        if source_mode == SourceMode.LOCAL and LocalBuilder.is_local(target):
+            key = os.path.abspath(target)
+        else:
+            key = JsonVplLoader._remote_url(target)
+        with JsonVplLoader._lock:
+            future = JsonVplLoader.shared.get(key)
+            owner = future is None
+            if owner:
+                future = JsonVplLoader.shared[key] = concurrent.futures.Future()
+        if not owner:
+            print("    - Loading " + target + " ... shared")
+            return future.result()
         try:
-            urllib.request.urlretrieve(file_url, filename)
-        except urllib.error.HTTPError:
-            return False
-        return True
+            future.set_result(JsonVplLoader._load(target, source_mode))
+        except BaseException as e:  # also the exit of an invalid target
+            future.set_exception(e)
+        return future.result()
 
     # remote is like https://raw.githubusercontent.com/qxcodefup/moodle/master/base/
+    # in local mode folders and json files are built here and the other targets are remote labels
     @staticmethod
-    def load(target: str, source_mode: SourceMode) -> JsonVPL:
-        if source_mode == SourceMode.REMOTE:
-            remote_url = Credentials.load_credentials().remote
-            url = os.path.join(remote_url, target + "/.cache/mapi.json")            
-            _fd, path = tempfile.mkstemp(suffix = "_" + target + '.json')
-            print("    - Loading from remote in"    + path + " ... ", end = "")
-            if JsonVplLoader.save_as(url, path):
-                print("done")
-                return JsonVplLoader._load_from_string(open(path).read())
+    def _load(target: str, source_mode: SourceMode) -> JsonVPL:
+        if source_mode == SourceMode.LOCAL and LocalBuilder.is_local(target):
+            print("    - Loading from local " + target + " ... ", end="")
+            try:
+                vpl, status = LocalBuilder.load(target)
+                print(status)
+                return vpl
+            except (OSError, ValueError, KeyError) as e:
+                print(type(e).__name__ + ": " + str(e))
+        else:
+            url = JsonVplLoader._remote_url(target)
+            print("    - Loading from remote " + url + " ... ", end="")
+            data, status = RemoteCache.get(url)
+            if data is not None:
+                print(status)
+                return JsonVplLoader._load_from_string(data.decode("utf-8"))
+            print(status)
         print("fail: invalid target " + target)
         exit(1)
 
 
+# routes the prints of worker threads to per thread buffers
+# each buffer is written as a single block to avoid interleaving the loading bars
+class Output:
+    _stdout = None
+    _buffer: contextvars.ContextVar = contextvars.ContextVar("output_buffer", default=None)
+    _lock = threading.Lock()
+
+    @staticmethod
+    def install():
+        if Output._stdout is None:
+            Output._stdout = sys.stdout
+            sys.stdout = Output()
+
+    # keeps the text printed by this thread inside the yielded list
+    # the threads started with the context of this one, see Workers, print there too
+    @staticmethod
+    @contextlib.contextmanager
+    def capture():
+        buffer: List[str] = []
+        token = Output._buffer.set(buffer)
+        try:
+            yield buffer
+        finally:
+            Output._buffer.reset(token)
+
+    @staticmethod
+    @contextlib.contextmanager
+    def block():
+        buffer: List[str] = []
+        try:
+            with Output.capture() as buffer:
+                yield
+        finally:
+            Output.write_block("".join(buffer))
+
+    # goes to the enclosing capture, if any
+    @staticmethod
+    def write_block(text: str):
+        buffer = Output._buffer.get()
+        if buffer is not None:
+            buffer.append(text)
+            return
+        with Output._lock:
+            Output._stdout.write(text)
+            Output._stdout.flush()
+
+    def write(self, text: str):
+        buffer = Output._buffer.get()
+        if buffer is not None:
+            buffer.append(text)
+            return
+        with Output._lock:
+            Output._stdout.write(text)
+
+    def flush(self):
+        if Output._buffer.get() is None:
+            Output._stdout.flush()
+
+
+# loads the next targets in background threads while the current ones are sent to moodle
+# at most depth vpls are loaded ahead, so memory stays flat on long target lists
+class Prefetcher:
+    depth: int = 4
+
+    @staticmethod
+    def _load(target: str, source_mode: SourceMode) -> Tuple[str, Optional[JsonVPL], str]:
+        vpl = None
+        with Output.capture() as log:
+            try:
+                vpl = JsonVplLoader.load(target, source_mode)
+            except SystemExit:
+                pass
+        return target, vpl, "".join(log)
+
+    # yields (target, vpl or None, loading log) in the order of targets
+    @staticmethod
+    def load_all(targets: Iterable[str], source_mode: SourceMode) -> Iterator[Tuple[str, Optional[JsonVPL], str]]:
+        Output.install()
+        depth = max(Prefetcher.depth, 1)
+        targets = iter(targets)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=depth) as pool:
+            pending = collections.deque(pool.submit(contextvars.copy_context().run, Prefetcher._load, target,
+                                                    source_mode) for target in itertools.islice(targets, depth))
+            while len(pending) > 0:
+                result = pending.popleft().result()
+                for target in itertools.islice(targets, 1):
+                    pending.append(pool.submit(contextvars.copy_context().run, Prefetcher._load, target, source_mode))
+                yield result
+
+
+# calls fn for each args tuple with at most jobs calls running at the same time
+# args are consumed only when a worker is free, keeping lazy producers bounded
+class Workers:
+    @staticmethod
+    def _call_block(fn: Callable, args: Tuple):
+        with Output.block():
+            fn(*args)
+
+    @staticmethod
+    def run(fn: Callable, args_list: Iterable[Tuple], jobs: int = 1):
+        if jobs <= 1:
+            for args in args_list:
+                fn(*args)
+            return
+        Output.install()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+            running = set()
+            for args in args_list:
+                if len(running) >= jobs:
+                    done, running = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+                running.add(pool.submit(contextvars.copy_context().run, Workers._call_block, fn, args))
+            for future in running:
+                future.result()
+
+
+# timed spans of the requests sent to moodle and of the Bar stages, enabled by --trace
+# each thread keeps the vpl being processed, the current stage and the retry count
+class Trace:
+    path: Optional[str] = None
+    chrome: bool = False  # chrome://tracing format instead of one json span per line
+    spans: List[Dict[str, Any]] = []
+    start: float = time.time()
+    _lock = threading.Lock()
+    _local = threading.local()
+    endpoints = {"modedit.php": "modedit", "executionfiles.json.php": "executionfiles.json",
+                 "requiredfiles.json.php": "requiredfiles.json", "executionoptions.php": "executionoptions",
+                 "executionkeepfiles.php": "keepfiles", "mod.php": "delete", "index.php": "login"}
+
+    @staticmethod
+    def enabled() -> bool:
+        return Trace.path is not None
+
+    # "https://host/course/modedit.php?update=12" -> "/course/modedit.php?update={}"
+    @staticmethod
+    def template(url: str) -> str:
+        path, _, query = url.strip().partition("?")
+        path = path.split("://", 1)[-1]
+        path = path[path.find("/"):] if "/" in path else "/"
+        keys = [param.split("=", 1)[0] + "={}" for param in query.split("&") if param != ""]
+        return path + ("?" + "&".join(keys) if keys else "")
+
+    @staticmethod
+    def endpoint(url: str) -> str:
+        path = url.strip().split("?")[0]
+        name = path.rsplit("/", 1)[-1]
+        if name == "view.php":
+            return path.rsplit("/", 2)[-2] + " view"
+        return Trace.endpoints.get(name, name)
+
+    @staticmethod
+    def set_vpl(vpl: Any):
+        Trace._local.vpl = vpl
+
+    @staticmethod
+    def set_retry(retry: int):
+        Trace._local.retry = retry
+
+    # vpl and retry of this thread, for requests sent by other threads on its behalf
+    @staticmethod
+    def context() -> Tuple[Any, int, str]:
+        return getattr(Trace._local, "vpl", None), getattr(Trace._local, "retry", 0), threading.current_thread().name
+
+    @staticmethod
+    def _span(cat: str, name: str, start: float, context: Optional[Tuple[Any, int, str]] = None) -> Dict[str, Any]:
+        vpl, _retry, thread = Trace.context() if context is None else context
+        return {"cat": cat, "name": name, "ts": round(start - Trace.start, 6), "dur": 0.0, "thread": thread,
+                "vpl": vpl}
+
+    @staticmethod
+    def _add(span: Dict[str, Any], start: float):
+        span["dur"] = round(time.time() - start, 6)
+        with Trace._lock:
+            Trace.spans.append(span)
+
+    # span of one request, the caller fills status and bytes with response()
+    @staticmethod
+    @contextlib.contextmanager
+    def request(method: str, url: str, context: Optional[Tuple[Any, int, str]] = None):
+        if not Trace.enabled():
+            yield {}
+            return
+        start = time.time()
+        context = Trace.context() if context is None else context
+        span = Trace._span("request", Trace.endpoint(url), start, context)
+        span.update({"method": method, "url": Trace.template(url), "status": None, "bytes_in": 0, "bytes_out": 0,
+                     "retry": context[1]})
+        try:
+            yield span
+        except Exception as e:
+            if span["status"] is None:
+                span["status"] = type(e).__name__
+            raise
+        finally:
+            Trace._add(span, start)
+
+    @staticmethod
+    def response(span: Dict[str, Any], response, stream: bool = False):
+        if not Trace.enabled():
+            return
+        body = (response.history[0] if response.history else response).request.body  # before redirects
+        Trace.sizes(span, response.status_code, body, None if stream else response.content)
+        if stream:
+            response.trace_span = span
+
+    @staticmethod
+    def sizes(span: Dict[str, Any], status: int, sent: Any, received: Any):
+        if not Trace.enabled():
+            return
+        span["status"] = status
+        span["bytes_out"] = len(sent) if isinstance(sent, (bytes, str, FilesPayload)) else 0
+        span["bytes_in"] = len(received) if isinstance(received, (bytes, str)) else 0
+
+    # bytes of a streamed response are known only after reading it
+    @staticmethod
+    def streamed(response):
+        span = getattr(response, "trace_span", None)
+        if span is not None:
+            span["bytes_in"] = response.raw.tell()
+
+    # closes the stage running in this thread and opens the next one
+    @staticmethod
+    def stage(name: Optional[str]):
+        if not Trace.enabled():
+            return
+        current = getattr(Trace._local, "stage", None)
+        if current is not None:
+            Trace._add(current[0], current[1])
+        Trace._local.stage = None
+        if name is not None:
+            start = time.time()
+            Trace._local.stage = (Trace._span("stage", name, start), start)
+
+    @staticmethod
+    def _percentile(values: List[float], p: float) -> float:
+        return values[min(len(values) - 1, int(round(p * (len(values) - 1))))]
+
+    @staticmethod
+    def summary():
+        print("- Time per endpoint")
+        print("    {:<22} {:>6} {:>8} {:>8} {:>9}".format("endpoint", "count", "p50", "p95", "total"))
+        for cat in ("request", "stage"):
+            durations: Dict[str, List[float]] = collections.defaultdict(list)
+            for span in Trace.spans:
+                if span["cat"] == cat:
+                    durations[span["name"]].append(span["dur"])
+            for name, values in sorted(durations.items(), key=lambda entry: -sum(entry[1])):
+                values.sort()
+                label = name if cat == "request" else "stage " + name
+                print("    {:<22} {:>6} {:>7.2f}s {:>7.2f}s {:>8.1f}s".format(
+                    label, len(values), Trace._percentile(values, 0.5), Trace._percentile(values, 0.95),
+                    sum(values)))
+
+    @staticmethod
+    def save():
+        with open(Trace.path, "w") as f:
+            if not Trace.chrome:
+                for span in Trace.spans:
+                    f.write(json.dumps(span) + "\n")
+                return
+            threads: Dict[str, int] = {}
+            events = []
+            for span in Trace.spans:
+                args = {key: value for key, value in span.items() if key not in ("cat", "name", "ts", "dur", "thread")}
+                events.append({"name": span["name"], "cat": span["cat"], "ph": "X", "pid": 1,
+                               "tid": threads.setdefault(span["thread"], len(threads) + 1),
+                               "ts": int(span["ts"] * 1e6), "dur": int(span["dur"] * 1e6), "args": args})
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
 # to print loading bar
 class Bar:
+    # done and fail counts of the items of the course of this thread in a fan-out
+    tally: contextvars.ContextVar = contextvars.ContextVar("bar_tally", default=None)
+    _lock = threading.Lock()
+
+    @staticmethod
+    def _count(result: str, item: bool):
+        tally = Bar.tally.get()
+        if tally is not None and item:
+            with Bar._lock:
+                tally[result] += 1
+
     @staticmethod
     def open():
+        Trace.set_vpl(None)
         print("    - [ ", end='', flush=True)
 
     @staticmethod
     def send(text: str, fill: int = 0):
+        if not text.isdigit() and not text.startswith("!"):  # ids and retry marks are printed, not stages
+            Trace.stage(text.strip())
         print(text.center(fill, '.') + " ", end='', flush=True)
 
     @staticmethod
-    def done(text=""):
+    def done(text="", item: bool = True):
+        Trace.stage(None)
+        Bar._count("done", item)
         print("] DONE" + text)
 
     @staticmethod
-    def fail(text=""):
+    def fail(text="", item: bool = True):
+        Trace.stage(None)
+        Bar._count("fail", item)
         print("] FAIL" + text)
 
 
@@ -282,114 +1186,537 @@ class StructureItem:
 
 
 # save course structure: sections, ids, titles
+# loaded is None for the whole course, or the sections read from their own pages, see StructureLoader
 class Structure:
-    def __init__(self, section_item_list: List[List[StructureItem]], section_labels: List[str]):
-        self.section_item_list: List[List[StructureItem]] = section_item_list
+    def __init__(self, section_item_list: List[List[StructureItem]], section_labels: List[str], title: str = "",
+                 loaded_at: Optional[float] = None, loaded: Optional[Iterable[int]] = None):
         self.section_labels: List[str] = section_labels
-        # redundant info
-        self.ids_dict: Dict[int, StructureItem] = self._make_ids_dict()
+        self.title: str = title
+        self.loaded_at: float = time.time() if loaded_at is None else loaded_at
+        self.loaded: Optional[set] = None if loaded is None else set(loaded)
+        # indexes by id, by section and by label, kept in sync by add_entry, set_title and rm_item
+        # the dicts of sections and labels keep the insertion order of the items
+        self.ids_dict: Dict[int, StructureItem] = {}
+        self.sections: List[Dict[int, StructureItem]] = [{} for _ in section_item_list]
+        self.labels: Dict[str, Dict[int, StructureItem]] = {}
+        # changes may come from the add workers
+        self.lock = threading.RLock()
+        for item_list in section_item_list:
+            for item in item_list:
+                self._index(item)
 
     def add_entry(self, section: int, qid: int, title: str):
-        if qid not in self.ids_dict.keys():
-            item = StructureItem(section, qid, title)
-            self.section_item_list[section].append(item)
-            self.ids_dict[qid] = item
+        with self.lock:
+            if qid not in self.ids_dict:
+                self._index(StructureItem(section, qid, title))
+
+    # title sent by an update, the item keeps its place in the section
+    def set_title(self, qid: int, title: str):
+        with self.lock:
+            item = self.ids_dict.get(qid)
+            if item is None or item.title == title:
+                return
+            same_label = self.labels[item.label]
+            del same_label[qid]
+            if len(same_label) == 0:
+                del self.labels[item.label]
+            item.title = title
+            item.label = StructureItem.parse_label(title)
+            self.labels.setdefault(item.label, {})[qid] = item
 
     def search_by_label(self, label: str, section: Optional[int] = None) -> List[StructureItem]:
         if label == "":
             return []
-        if section is None:
-            return [item for item in self.ids_dict.values() if item.label == label]
-        return [item for item in self.section_item_list[section] if item.label == label]
+        with self.lock:
+            items = self.labels.get(label, {}).values()
+            if section is None:
+                return list(items)
+            return [item for item in items if item.section == section]
 
     def get_id_list(self, section: Optional[int] = None) -> List[int]:
         if section is None:
             return list(self.ids_dict.keys())
-        return [item.id for item in self.section_item_list[section]]
+        return list(self.sections[section].keys())
 
     def get_itens(self, section: Optional[int] = None) -> List[StructureItem]:
         if section is None:
             return list(self.ids_dict.values())
-        return self.section_item_list[section]
+        return list(self.sections[section].values())
 
     def get_item(self, qid: int) -> StructureItem:
         return self.ids_dict[qid]
 
     def has_id(self, qid: int, section: Optional[int] = None) -> bool:
         if section is None:
-            return qid in self.ids_dict.keys()
-        return qid in self.get_id_list(section)
+            return qid in self.ids_dict
+        return qid in self.sections[section]
 
     def rm_item(self, qid: int):
-        if self.has_id(qid):
-            item = self.ids_dict[qid]
-            del self.ids_dict[qid]
-            new_section_list = [item for item in self.section_item_list[item.section] if item.id != qid]
-            self.section_item_list[item.section] = new_section_list
+        with self.lock:
+            item = self.ids_dict.pop(qid, None)
+            if item is None:
+                return
+            del self.sections[item.section][qid]
+            same_label = self.labels[item.label]
+            del same_label[qid]
+            if len(same_label) == 0:
+                del self.labels[item.label]
 
     def get_number_of_sections(self):
         return len(self.section_labels)
 
-    def _make_ids_dict(self) -> Dict[int, StructureItem]:
-        entries: Dict[int, StructureItem] = {}
-        for item_list in self.section_item_list:
-            for item in item_list:
-                entries[item.id] = item
-        return entries
+    def has_sections(self, sections: Optional[List[int]]) -> bool:
+        if self.loaded is None:
+            return True
+        return sections is not None and self.loaded.issuperset(sections)
+
+    # sections loaded from other pages replace the ones kept here
+    def merge(self, other: 'Structure'):
+        with self.lock:
+            for section in sorted(other.loaded if other.loaded is not None else range(len(other.section_labels))):
+                while len(self.section_labels) <= section:
+                    self.section_labels.append("")
+                    self.sections.append({})
+                for qid in list(self.sections[section].keys()):
+                    self.rm_item(qid)
+                self.section_labels[section] = other.section_labels[section]
+                for item in other.get_itens(section):
+                    self._index(item)
+            if self.loaded is not None:
+                self.loaded = None if other.loaded is None else self.loaded | other.loaded
+            self.loaded_at = min(self.loaded_at, other.loaded_at)
+
+    def _index(self, item: StructureItem):
+        self.ids_dict[item.id] = item
+        self.sections[item.section][item.id] = item
+        self.labels.setdefault(item.label, {})[item.id] = item
+
+
+# course structure saved on disk by url and course id, valid for ttl seconds
+# mapi rewrites the entry itself when it adds, renames or removes vpls, once at the end of the command
+class StructureCache:
+    ttl: int = 600
+    refresh: bool = False
+    keep_in_memory: bool = False  # set by the daemon, the structure is reused without reading the file
+    _memory: Dict[str, Structure] = {}
+    _changed: Dict[str, Tuple[Structure, URLHandler]] = {}  # course -> structure to write by flush
+    _lock = threading.Lock()
+
+    @staticmethod
+    def _path(url_handler: URLHandler) -> str:
+        key = hashlib.sha1(str(url_handler).encode()).hexdigest()[:16]
+        return os.path.join(Credentials.cache_dir(), "structure_" + key + ".json")
+
+    @staticmethod
+    def load(url_handler: URLHandler) -> Optional[Structure]:
+        structure = StructureCache._memory.get(str(url_handler))
+        if structure is not None and time.time() - structure.loaded_at <= StructureCache.ttl:
+            return structure
+        try:
+            with open(StructureCache._path(url_handler)) as f:
+                data = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        if data.get("key") != str(url_handler) or time.time() - data["time"] > StructureCache.ttl:
+            return None
+        section_item_list = [[StructureItem(index, qid, title) for qid, title in section["items"]]
+                             for index, section in enumerate(data["sections"])]
+        section_labels = [section["label"] for section in data["sections"]]
+        structure = Structure(section_item_list, section_labels, data["title"], data["time"], data.get("loaded"))
+        if StructureCache.keep_in_memory:
+            StructureCache._memory[str(url_handler)] = structure
+        return structure
+
+    # the structure changed, it is written by flush
+    @staticmethod
+    def mark(structure: Structure, url_handler: Optional[URLHandler] = None):
+        if url_handler is None:
+            url_handler = URLHandler()
+        with StructureCache._lock:
+            StructureCache._changed[str(url_handler)] = (structure, url_handler)
+
+    @staticmethod
+    def flush():
+        with StructureCache._lock:
+            changed = list(StructureCache._changed.values())
+            StructureCache._changed.clear()
+        for structure, url_handler in changed:
+            StructureCache.save(structure, url_handler)
+
+    @staticmethod
+    def save(structure: Structure, url_handler: Optional[URLHandler] = None):
+        if url_handler is None:
+            url_handler = URLHandler()
+        with structure.lock:
+            sections = [{"label": label, "items": [[item.id, item.title] for item in structure.get_itens(index)]}
+                        for index, label in enumerate(structure.section_labels)]
+            data = {"key": str(url_handler), "time": structure.loaded_at, "title": structure.title,
+                    "sections": sections, "loaded": None if structure.loaded is None else sorted(structure.loaded)}
+            path = StructureCache._path(url_handler)
+            with open(path + ".tmp", "w") as f:
+                f.write(json.dumps(data))
+            os.replace(path + ".tmp", path)
+        if StructureCache.keep_in_memory:
+            StructureCache._memory[str(url_handler)] = structure
+
+
+# hash of the last content pushed to each vpl, stored in .mapi_cache/state.sqlite
+# changes made on moodle by other means are not seen here
+class SyncState:
+    _lock = threading.Lock()
+
+    @staticmethod
+    def _connect() -> 'sqlite3.Connection':
+        db = sqlite3.connect(os.path.join(Credentials.cache_dir(), "state.sqlite"), timeout=30)
+        db.execute("CREATE TABLE IF NOT EXISTS stages "
+                   "(course TEXT, qid INTEGER, stage TEXT, hash TEXT, time REAL, PRIMARY KEY (course, qid, stage))")
+        return db
+
+    # stage -> hash of the last content sent in that stage
+    @staticmethod
+    def get(qid: int) -> Dict[str, str]:
+        with SyncState._lock, contextlib.closing(SyncState._connect()) as db:
+            rows = db.execute("SELECT stage, hash FROM stages WHERE course = ? AND qid = ?",
+                              (str(URLHandler()), qid)).fetchall()
+        return {stage: stage_hash for stage, stage_hash in rows}
+
+    @staticmethod
+    def set(qid: int, stage: str, stage_hash: str):
+        with SyncState._lock, contextlib.closing(SyncState._connect()) as db, db:
+            db.execute("INSERT OR REPLACE INTO stages VALUES (?, ?, ?, ?, ?)",
+                       (str(URLHandler()), qid, stage, stage_hash, time.time()))
+
+    @staticmethod
+    def remove(qid: int):
+        with SyncState._lock, contextlib.closing(SyncState._connect()) as db, db:
+            db.execute("DELETE FROM stages WHERE course = ? AND qid = ?", (str(URLHandler()), qid))
+
+
+# write-ahead journal of the add, update, sync and rm runs, also in .mapi_cache/state.sqlite
+# the stages of each item are written as planned before being sent and as done after,
+# so --resume skips what an interrupted run finished and completes the vpls it created
+class Journal:
+    resume: bool = False
+    runs: Dict[str, int] = {}  # course -> run of the journaled command running on it
+    _lock = threading.Lock()
+
+    @staticmethod
+    def _connect() -> 'sqlite3.Connection':
+        db = sqlite3.connect(os.path.join(Credentials.cache_dir(), "state.sqlite"), timeout=30)
+        db.execute("CREATE TABLE IF NOT EXISTS runs "
+                   "(run INTEGER PRIMARY KEY, course TEXT, command TEXT, time REAL, finished INTEGER)")
+        db.execute("CREATE TABLE IF NOT EXISTS journal "
+                   "(run INTEGER, item TEXT, stage TEXT, state TEXT, value TEXT, time REAL, "
+                   "PRIMARY KEY (run, item, stage))")
+        return db
+
+    # continues the last unfinished run of the command with --resume, otherwise starts a new one
+    @staticmethod
+    def start(command: str):
+        course = str(URLHandler())
+        with Journal._lock, contextlib.closing(Journal._connect()) as db, db:
+            row = None
+            if Journal.resume:
+                row = db.execute("SELECT run, time FROM runs WHERE course = ? AND command = ? AND finished = 0 "
+                                 "ORDER BY run DESC LIMIT 1", (course, command)).fetchone()
+                if row is None:
+                    print("- Nothing to resume for " + command + ", starting a new run")
+            if row is not None:
+                Journal.runs[course] = row[0]
+                done = db.execute("SELECT COUNT(*) FROM journal WHERE run = ? AND stage = 'item' AND state = 'done'",
+                                  (row[0],)).fetchone()[0]
+                creating = db.execute("SELECT COUNT(*) FROM journal WHERE run = ? AND stage = 'create' "
+                                      "AND state = 'planned'", (row[0],)).fetchone()[0]
+                print("- Resuming " + command + " from " + time.strftime("%Y-%m-%d %H:%M", time.localtime(row[1])) +
+                      ": " + str(done) + " items done")
+                if creating > 0:  # the new vpls may be on moodle without being in the cached structure
+                    StructureCache.refresh = True
+                return
+            old = [run for run, in db.execute("SELECT run FROM runs WHERE course = ? AND command = ?",
+                                              (course, command))]
+            db.executemany("DELETE FROM journal WHERE run = ?", [(run,) for run in old])
+            db.execute("DELETE FROM runs WHERE course = ? AND command = ?", (course, command))
+            Journal.runs[course] = db.execute("INSERT INTO runs (course, command, time, finished) VALUES (?, ?, ?, 0)",
+                                     (course, command, time.time())).lastrowid
+
+    # the run is finished when no started item is left behind
+    @staticmethod
+    def finish():
+        run = Journal.runs.pop(str(URLHandler()), None)
+        if run is None:
+            return
+        with Journal._lock, contextlib.closing(Journal._connect()) as db, db:
+            pending = db.execute("SELECT COUNT(*) FROM journal WHERE run = ? AND stage = 'item' AND state = 'planned'",
+                                 (run,)).fetchone()[0]
+            if pending == 0:
+                db.execute("UPDATE runs SET finished = 1 WHERE run = ?", (run,))
+        if pending > 0:
+            print("- " + str(pending) + " items not finished, run the same command with --resume to finish them")
+
+    # None outside of a journaled command
+    @staticmethod
+    def _run() -> Optional[int]:
+        return Journal.runs.get(str(URLHandler()))
+
+    # stage -> (state, value) of the item in the resumed run
+    # a new run only writes, so an item repeated in the same command is sent again
+    @staticmethod
+    def get(item: str) -> Dict[str, Tuple[str, str]]:
+        run = Journal._run()
+        if run is None or not Journal.resume:
+            return {}
+        with Journal._lock, contextlib.closing(Journal._connect()) as db:
+            rows = db.execute("SELECT stage, state, value FROM journal WHERE run = ? AND item = ?",
+                              (run, item)).fetchall()
+        return {stage: (state, value) for stage, state, value in rows}
+
+    @staticmethod
+    def is_done(item: str, stage: str = "item") -> bool:
+        return Journal.get(item).get(stage, ("", ""))[0] == "done"
 
+    @staticmethod
+    def plan(item: str, stages: List[str], value: str = ""):
+        Journal._write([(item, stage, "planned", value) for stage in ["item"] + stages])
 
+    @staticmethod
+    def done(item: str, stage: str = "item", value: str = ""):
+        Journal._write([(item, stage, "done", value)])
+
+    @staticmethod
+    def _write(entries: List[Tuple[str, str, str, str]]):
+        run = Journal._run()
+        if run is None:
+            return
+        now = time.time()
+        with Journal._lock, contextlib.closing(Journal._connect()) as db, db:
+            db.executemany("INSERT OR REPLACE INTO journal VALUES (?, ?, ?, ?, ?, ?)",
+                           [(run, item, stage, state, value, now) for item, stage, state, value in entries])
+
+
+# the whole course page is loaded only when the command needs all the sections
+# with sections, only the missing ones are read from their own pages, at the same time
 class StructureLoader:
     @staticmethod
-    def load() -> Structure:
-        api = MoodleAPI()
-        print("- Loading course structure")
+    def load(sections: Optional[List[int]] = None) -> Structure:
+        url_handler = URLHandler()
+        cached = None if StructureCache.refresh else StructureCache.load(url_handler)
+        if cached is not None and cached.has_sections(sections):
+            print("- Loading course structure from cache (--refresh to reload)")
+            print(cached.title)
+            return cached
+
+        if sections is None:
+            print("- Loading course structure")
+            urls = [url_handler.course()]
+        else:
+            missing = sorted(set(sections) - (cached.loaded if cached is not None else set()))
+            print("- Loading course structure of section" + ("s " if len(missing) > 1 else " ") +
+                  ", ".join(str(section) for section in missing))
+            urls = [url_handler.course_section(section) for section in missing]
         Bar.open()
         Bar.send("load")
-        while True:
-            try:
-                api.open_url(api.urlHandler.course())
-                break
-            except Exception as _e:
-                print(type(_e))  # debug
-                print(_e)
-                Bar.send("!", 0)
-                api = MoodleAPI()
+
+        def load_page(url: str) -> CoursePageParser:
+            api = MoodleAPI.create()
+            return Retry.call(lambda: StructureLoader._parse(api, url))
+
+        try:
+            if len(urls) == 1:
+                parsers = [load_page(urls[0])]
+            else:
+                workers = min(len(urls), Throttle.max_inflight)
+                with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+                    futures = [pool.submit(contextvars.copy_context().run, load_page, url) for url in urls]
+                    parsers = [future.result() for future in futures]
+        except Exception as _e:
+            Bar.fail(": " + str(_e), item=False)
+            exit(1)
 
         Bar.send("parse")
-        soup = api.browser.page  # BeautifulSoup(api.browser.response().read(), 'html.parser')
-        topics = soup.find('ul', {'class:', 'topics'})
-        section_item_list = StructureLoader._make_entries_by_section(soup, topics.contents)
-        section_labels: List[str] = StructureLoader._make_section_labels(topics.contents)
-        Bar.done()
-        print(soup.title.string)
-        return Structure(section_item_list, section_labels)
-
-    @staticmethod
-    def _make_section_labels(childrens) -> List[str]:
-        return [section['aria-label'] for section in childrens]
-
-    @staticmethod
-    def _make_entries_by_section(soup, childrens) -> List[List[StructureItem]]:
-        output: List[List[StructureItem]] = []
-        for section_index, section in enumerate(childrens):
-            comp = ' > div.content > ul > li > div > div.mod-indent-outer > div > div.activityinstance > a'
-            activities = soup.select('#' + section['id'] + comp)
-            section_entries: List[StructureItem] = []
-            for activity in activities:
-                if not URLHandler.is_vpl_url(activity['href']):
-                    continue
-                qid: int = int(URLHandler.parse_id(activity['href']))
-                title: str = activity.get_text().replace(' Laboratório Virtual de Programação', '')
-                section_entries.append(StructureItem(section_index, qid, title))
-            output.append(section_entries)
-        return output
+        structure = parsers[0].structure(partial=sections is not None)
+        for parser in parsers[1:]:
+            structure.merge(parser.structure(partial=True))
+        if cached is not None and sections is not None:
+            cached.merge(structure)
+            structure = cached
+        if not structure.has_sections(sections):
+            missing = sorted(set(sections) - structure.loaded)
+            Bar.fail(": section " + ", ".join(str(section) for section in missing) + " not found in the course",
+                     item=False)
+            exit(1)
+        Bar.done(item=False)
+        print(structure.title)
+        StructureCache.save(structure, url_handler)
+        return structure
+
+    @staticmethod
+    def _parse(api: 'MoodleAPI', url: str) -> 'CoursePageParser':
+        page_parser = CoursePageParser()
+        api.stream_page(url, page_parser)
+        return page_parser
+
+
+# single pass over the course page html, filling section labels and vpl items together
+# the page is fed in chunks, so neither the whole text nor a soup is kept in memory
+class CoursePageParser(html.parser.HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.title: str = ""
+        self.section_labels: List[str] = []
+        self.section_item_list: List[List[StructureItem]] = []
+        self._in_title: bool = False
+        self._topics: List[bool] = []  # for each open ul, if it is the ul.topics
+        self._instance: bool = False  # inside div.activityinstance waiting for the link
+        self._vpl_id: Optional[int] = None  # id of the open vpl link
+        self._text: List[str] = []
+        self._section: Optional[int] = None  # number of the open section, from its id
+        self._found: List[int] = []  # sections present in the page
+
+    # a single section page has only some of the sections
+    def structure(self, partial: bool = False) -> Structure:
+        return Structure(self.section_item_list, self.section_labels, self.title,
+                         loaded=self._found if partial else None)
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'title':
+            self._in_title = True
+        elif tag == 'ul':
+            self._topics.append('topics' in (dict(attrs).get('class') or '').split())
+        elif tag == 'li' and len(self._topics) == 1 and self._topics[0]:
+            attrs = dict(attrs)
+            if attrs.get('id', '').startswith('section-') and 'aria-label' in attrs:
+                section = attrs['id'][len('section-'):]
+                self._section = int(section) if section.isdigit() else len(self.section_labels)
+                while len(self.section_labels) <= self._section:
+                    self.section_labels.append("")
+                    self.section_item_list.append([])
+                self.section_labels[self._section] = attrs['aria-label']
+                self._found.append(self._section)
+        elif tag == 'div' and self._section is not None:
+            if 'activityinstance' in (dict(attrs).get('class') or '').split():
+                self._instance = True
+        elif tag == 'a' and self._instance:
+            self._instance = False
+            href = dict(attrs).get('href') or ''
+            if URLHandler.is_vpl_url(href):
+                self._vpl_id = int(URLHandler.parse_id(href))
+                self._text = []
+
+    def handle_endtag(self, tag):
+        if tag == 'title':
+            self._in_title = False
+        elif tag == 'ul' and len(self._topics) > 0:
+            self._topics.pop()
+        elif tag == 'a' and self._vpl_id is not None:
+            title = "".join(self._text).replace(' Laboratório Virtual de Programação', '')
+            self.section_item_list[self._section].append(StructureItem(self._section, self._vpl_id, title))
+            self._vpl_id = None
+
+    def handle_data(self, data):
+        if self._in_title:
+            self.title += data
+        elif self._vpl_id is not None:
+            self._text.append(data)
+
+
+# single pass over view.php: title, description and the files shown in the page
+class VplPageParser(html.parser.HTMLParser):
+    def __init__(self, url: str):
+        super().__init__(convert_charrefs=True)
+        self.url = url
+        self.title: str = ""
+        self.description: str = ""
+        self.files: List[Tuple[str, JsonFile]] = []  # (header of the section, file)
+        self._text: Optional[List[str]] = None  # text of the open element being collected
+        self._target: str = ""  # title, description, header, name or contents
+        self._header: str = ""
+        self._name: str = ""
+        self._in_box: bool = False
+        self._divs: int = 0  # open divs inside the description
+
+    def vpl(self) -> JsonVPL:
+        vpl = JsonVPL(self.title, self.description)
+        for header, file in self.files:
+            if header == "Arquivos requeridos":
+                vpl.required.append(file)
+            else:
+                vpl.upload.append(file)
+        return vpl
+
+    def _collect(self, target: str):
+        self._text = []
+        self._target = target
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        classes = (attrs.get('class') or '').split()
+        if tag == 'div':
+            if self._divs > 0:
+                self._divs += 1
+            elif self._in_box and 'no-overflow' in classes and self.description == "":
+                self._divs = 1
+                self._collect("description")
+            elif {'box', 'py-3', 'generalbox'}.issubset(classes):
+                self._in_box = True
+        elif self._divs > 0:
+            return
+        elif tag == 'a' and self.title == "" and attrs.get('href') == self.url:
+            self._collect("title")
+        elif tag == 'h2':
+            self._collect("header")
+        elif tag == 'h4' and (attrs.get('id') or '').startswith('fileid'):
+            self._collect("name")
+        elif tag == 'pre' and (attrs.get('id') or '').startswith('codefileid'):
+            self._collect("contents")
+
+    def handle_endtag(self, tag):
+        if self._text is None:
+            return
+        if tag == 'div' and self._divs > 0:
+            self._divs -= 1
+            if self._divs > 0:
+                return
+            self._in_box = False
+        elif self._divs > 0 or tag != {"title": "a", "header": "h2", "name": "h4", "contents": "pre"}[self._target]:
+            return
+        text = "".join(self._text)
+        self._text = None
+        if self._target == "title":
+            self.title = text
+        elif self._target == "description":
+            self.description = text
+        elif self._target == "header":
+            self._header = text
+        elif self._target == "name":
+            self._name = text
+        else:
+            self.files.append((self._header, JsonFile(self._name, text)))
+
+    def handle_data(self, data):
+        if self._text is not None:
+            self._text.append(data)
+
+
+# collects the text of a non html answer read by stream_page
+class TextPage:
+    def __init__(self):
+        self.chunks: List[str] = []
+
+    def feed(self, data: str):
+        self.chunks.append(data)
+
+    def close(self):
+        pass
+
+    def text(self) -> str:
+        return "".join(self.chunks)
 
 
 # formatting structure to list
 class Viewer:
-    def __init__(self, show_url: bool):
+    def __init__(self, show_url: bool, sections: Optional[List[int]] = None):
         self.url_handler = URLHandler()
-        self.structure = StructureLoader.load()
+        self.structure = StructureLoader.load(sections)
         self.show_url = show_url
 
     def list_section(self, index: int):
@@ -406,252 +1733,816 @@ class Viewer:
             self.list_section(i)
 
 
+# moodle answered with a 5xx status
+class ServerError(Exception):
+    pass
+
+
+# moodle still answers with the login page after a new login
+class AuthError(Exception):
+    pass
+
+
+# the retries allowed for the whole run are over
+class RetryBudgetError(Exception):
+    pass
+
+
+# pauses every worker when most of the recent requests failed by timeout or 5xx
+class CircuitBreaker:
+    window: int = 20
+    min_samples: int = 6
+    threshold: float = 0.5
+    cooldown: float = 15.0
+
+    def __init__(self):
+        self.results: collections.deque = collections.deque(maxlen=CircuitBreaker.window)
+        self.open_until: float = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            delay = self.open_until - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+    def record(self, success: bool):
+        with self.lock:
+            self.results.append(success)
+            failures = self.results.count(False)
+            if len(self.results) < CircuitBreaker.min_samples or failures < len(self.results) * self.threshold:
+                return
+            if time.time() < self.open_until:
+                return
+            self.open_until = time.time() + CircuitBreaker.cooldown
+            self.results.clear()
+        print("(paused " + str(int(CircuitBreaker.cooldown)) + "s: too many errors) ", end="", flush=True)
+
+
+# shared retry engine: exponential backoff with jitter, limits by kind of error,
+# a retry budget for the whole run and the circuit breaker, both kept for each moodle host
+class Retry:
+    base_delay: float = 1.0
+    max_delay: float = 30.0
+    max_attempts: Dict[str, int] = {"timeout": 5, "server": 6, "auth": 2, "error": 3}
+    budget: int = 100
+    instances: Dict[str, 'Retry'] = {}  # host -> breaker and budget
+    _lock = threading.Lock()
+
+    def __init__(self):
+        self.breaker = CircuitBreaker()
+        self.used: int = 0
+
+    # state of the host of the active course
+    @staticmethod
+    def get() -> 'Retry':
+        host = urllib.parse.urlsplit(Credentials.load_credentials().url).netloc
+        with Retry._lock:
+            if host not in Retry.instances:
+                Retry.instances[host] = Retry()
+            return Retry.instances[host]
+
+    @staticmethod
+    def kind(error: Exception) -> str:
+        if isinstance(error, (requests.Timeout, requests.ConnectionError)):
+            return "timeout"
+        if isinstance(error, ServerError):
+            return "server"
+        if isinstance(error, AuthError):
+            return "auth"
+        return "error"
+
+    @staticmethod
+    def delay(attempt: int) -> float:
+        return min(Retry.max_delay, Retry.base_delay * 2 ** attempt) * random.uniform(0.5, 1.5)
+
+    def _spend(self):
+        with Retry._lock:
+            if self.used >= Retry.budget:
+                raise RetryBudgetError("retry budget of " + str(Retry.budget) + " exhausted")
+            self.used += 1
+
+    # calls action until it works, raising the last error when the attempts for its kind are over
+    @staticmethod
+    def call(action: Callable[[], Any]) -> Any:
+        state = Retry.get()
+        attempt = 0
+        while True:
+            state.breaker.wait()
+            Trace.set_retry(attempt)
+            try:
+                result = action()
+                state.breaker.record(True)
+                Trace.set_retry(0)
+                return result
+            except Exception as e:
+                Trace.set_retry(0)
+                kind = Retry.kind(e)
+                if kind in ("timeout", "server"):
+                    state.breaker.record(False)
+                attempt += 1
+                if attempt >= Retry.max_attempts[kind]:
+                    raise
+                state._spend()
+                Bar.send("!" + kind, 0)
+                if kind != "auth":  # the next attempt already logs in again
+                    time.sleep(Retry.delay(attempt - 1))
+
+
+# client side limits for the requests sent to each moodle host, shared by all workers
+# AIMD: the requests in flight and the requests per second grow by one step while moodle answers
+# as fast as usual and are cut by half when it gets slow or fails with timeout or 5xx
+# the requests per second have no limit until the first cut, which starts from the rate moodle was answering
+class Throttle:
+    max_inflight: int = 1
+    max_rate: Optional[float] = None  # set by --max-rate
+    min_rate: float = 0.5
+    slow_factor: float = 3.0  # slower than slow_factor times the fastest answer of the endpoint
+    slow_min: float = 1.0  # answers faster than this in seconds are never slow
+    instances: Dict[str, 'Throttle'] = {}  # host -> limits
+    _lock = threading.Lock()
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.limit: float = 1.0
+        self.rate: float = math.inf if Throttle.max_rate is None else Throttle.max_rate
+        self.tokens: float = 1.0
+        self.last: float = time.time()
+        self.inflight: int = 0
+        self.base_latency: Dict[str, float] = {}
+        self.last_cut: float = 0
+        self.requests: int = 0
+        self.cuts: int = 0
+
+    @staticmethod
+    def get(url: str) -> 'Throttle':
+        host = urllib.parse.urlsplit(url).netloc
+        with Throttle._lock:
+            if host not in Throttle.instances:
+                Throttle.instances[host] = Throttle()
+            return Throttle.instances[host]
+
+    # "https://host/mod/vpl/forms/executionfiles.json.php?id=2" -> "executionfiles.json.php"
+    @staticmethod
+    def endpoint(url: str) -> str:
+        return url.split("?")[0].rsplit("/", 1)[-1]
+
+    @contextlib.contextmanager
+    def request(self, url: str):
+        self._acquire()
+        with self._measure(url):
+            yield
+
+    @contextlib.contextmanager
+    def _measure(self, url: str):
+        start = time.time()
+        congested = False
+        try:
+            yield
+        except (requests.Timeout, requests.ConnectionError, ServerError):
+            congested = True
+            raise
+        finally:
+            self._release(Throttle.endpoint(url), time.time() - start, congested)
+
+    def limits(self) -> Dict[str, Any]:
+        with self.cond:
+            rate = "no rate limit" if self.rate == math.inf else str(round(self.rate, 1)) + " req/s"
+            return {"inflight": int(self.limit), "rate": rate, "requests": self.requests, "slowdowns": self.cuts}
+
+    def _acquire(self):
+        with self.cond:
+            delay = self._try_acquire()
+            while delay > 0:
+                self.cond.wait(delay)
+                delay = self._try_acquire()
+
+    # takes a slot and a token when both are free, otherwise returns how long to wait, called holding cond
+    def _try_acquire(self) -> float:
+        if self.inflight >= int(self.limit):
+            return 0.05  # woken up before by notify_all when a request ends
+        if self.rate != math.inf:
+            now = time.time()
+            self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens < 1:
+                return (1 - self.tokens) / self.rate
+            self.tokens -= 1
+        self.inflight += 1
+        return 0
+
+    def _release(self, endpoint: str, latency: float, congested: bool):
+        with self.cond:
+            self.inflight -= 1
+            self.requests += 1
+            base = self.base_latency.get(endpoint, latency)
+            self.base_latency[endpoint] = min(latency, base + (latency - base) * 0.05)
+            slow = latency > Throttle.slow_min and latency > base * Throttle.slow_factor
+            if congested or slow:
+                # cut once per round of requests, the answers already in flight saw the same moodle
+                if time.time() - self.last_cut > max(latency, 1.0):
+                    answering = self.limit / max(latency, 0.001)  # requests in flight by seconds of each one
+                    if self.rate == math.inf:
+                        self.tokens, self.last = 1.0, time.time()
+                    self.limit = max(1.0, self.limit / 2)
+                    self.rate = max(Throttle.min_rate, min(self.rate, answering) / 2)
+                    self.last_cut = time.time()
+                    self.cuts += 1
+            else:
+                self.limit = min(float(Throttle.max_inflight), self.limit + 1 / self.limit)
+                self.rate = self.rate + 1 / max(1.0, self.rate)
+                if Throttle.max_rate is not None:
+                    self.rate = min(Throttle.max_rate, self.rate)
+            self.cond.notify_all()
+
+
+# forms learned once per login and filled again without loading their page, see MoodleAPI._send_form
+# only forms whose fields do not depend on the vpl content: new vpl, delete and the
+# execution options of vpls created in this run
+# the keep files form lists the files of each vpl with their checkboxes, so its page is always loaded
+class FormTemplates:
+    enabled: bool = True
+    # kind:course:session -> (login generation, page url, form html)
+    _templates: Dict[str, Tuple[int, str, str]] = {}
+    _lock = threading.Lock()
+
+    # the form keeps the sesskey of the session that loaded it
+    @staticmethod
+    def _key(kind: str, api: 'MoodleAPI') -> str:
+        return kind + ":" + str(api.urlHandler) + ":" + str(api.sessions.slot)
+
+    @staticmethod
+    def get(kind: str, api: 'MoodleAPI') -> Optional[Tuple[str, str]]:
+        with FormTemplates._lock:
+            template = FormTemplates._templates.get(FormTemplates._key(kind, api))
+        if not FormTemplates.enabled or template is None or template[0] != api.sessions.generation:
+            return None  # the sesskey of the template belongs to other login
+        return template[1], template[2]
+
+    @staticmethod
+    def learn(kind: str, api: 'MoodleAPI', url: str, form_html: str):
+        with FormTemplates._lock:
+            FormTemplates._templates[FormTemplates._key(kind, api)] = (api.sessions.generation, url, form_html)
+
+    @staticmethod
+    def drop(kind: str, api: 'MoodleAPI'):
+        with FormTemplates._lock:
+            FormTemplates._templates.pop(FormTemplates._key(kind, api), None)
+
+
+# keeps the authenticated cookies on disk and shares them with every MoodleAPI of the same login
+# login is done again only when moodle answers with the login page
+# moodle answers the requests of one session one at a time, so each login keeps a pool of size sessions
+# and the threads take them in turns, the workers of a pool started together get different sessions
+class SessionManager:
+    size: int = 1  # set to --jobs
+    instances: Dict[str, 'SessionManager'] = {}  # url:username:slot -> manager
+    _next = itertools.count()  # slot of the next thread that sends requests
+    _local = threading.local()
+    _lock = threading.Lock()
+
+    def __init__(self, credentials: Credentials, slot: int = 0):
+        self.credentials = credentials
+        self.slot: int = slot
+        key = hashlib.sha1((credentials.url + ":" + credentials.username).encode()).hexdigest()[:16]
+        name = "session_" + key + ("" if slot == 0 else "_" + str(slot)) + ".json"
+        self.path = os.path.join(Credentials.cache_dir(), name)
+        self.cookies = requests.cookies.RequestsCookieJar()
+        self.generation: int = 0  # incremented on each login
+        self.lock = threading.Lock()
+        self._load()
+
+    @staticmethod
+    def get() -> 'SessionManager':
+        credentials = Credentials.load_credentials()
+        with SessionManager._lock:
+            if getattr(SessionManager._local, "turn", None) is None:
+                SessionManager._local.turn = next(SessionManager._next)
+            slot = SessionManager._local.turn % max(1, SessionManager.size)
+            key = credentials.url + ":" + credentials.username + ":" + str(slot)
+            if key not in SessionManager.instances:
+                SessionManager.instances[key] = SessionManager(credentials, slot)
+            return SessionManager.instances[key]
+
+    def has_session(self) -> bool:
+        return len(self.cookies) > 0
+
+    # login using the api browser, unless other api already did it after generation
+    def renew(self, api: 'MoodleAPI', generation: int):
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.cookies.clear()
+            api._login()
+            self.generation += 1
+            self._save()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                for cookie in json.load(f):
+                    self.cookies.set_cookie(requests.cookies.create_cookie(**cookie))
+        except (FileNotFoundError, json.JSONDecodeError, TypeError):
+            self.cookies.clear()
+
+    def _save(self):
+        data = [{"name": c.name, "value": c.value, "domain": c.domain, "path": c.path, "secure": c.secure,
+                 "expires": c.expires} for c in self.cookies]
+        fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            f.write(json.dumps(data, indent=4) + "\n")
+
+
 class MoodleAPI:
     default_timeout: int = 10
+    execution_options: Dict[str, str] = {"run": "1", "debug": "1", "evaluate": "1", "automaticgrading": "1"}
+    json_download: bool = True  # turned off when the json file endpoints do not answer json
+    created: set = set()  # (url, id) of the vpls created in this run, their forms still have the default values
+
+    @staticmethod
+    def create() -> 'MoodleAPI':
+        return MoodleAPI()
 
     def __init__(self):
         self.credentials = Credentials.load_credentials()
         self.urlHandler = URLHandler()
         self.browser = mechanicalsoup.StatefulBrowser(user_agent='MechanicalSoup')
         self.browser.set_user_agent('Mozilla/5.0')
-        self._login()
+        self.sessions = SessionManager.get()
+        self.browser.session.cookies = self.sessions.cookies
+        self.status: int = 0  # of the last answer
+        if not self.sessions.has_session():
+            generation = self.sessions.generation
+            Retry.call(lambda: self.sessions.renew(self, generation))
 
     def open_url(self, url: str, data_files: Optional[Any] = None):
-        if MoodleAPI.default_timeout != 0:
-            if data_files is None:
-                self.browser.open(url, timeout=MoodleAPI.default_timeout)
-            else:
-                self.browser.open(url, timeout=MoodleAPI.default_timeout, data=data_files)
-        else:
-            if data_files is None:
-                self.browser.open(url)
+        generation = self.sessions.generation
+        self._open(url, data_files)
+        if self._is_login_page():
+            self.sessions.renew(self, generation)
+            self._open(url, data_files)
+            if self._is_login_page():
+                raise AuthError("redirected to login page: " + url)
+
+    def _submit(self):
+        url = requests.compat.urljoin(self.browser.get_url(), self.browser.get_current_form().form.get("action", ""))
+        with self._request("POST", url) as span:
+            response = self.browser.submit_selected()
+            Trace.response(span, response)
+            self.status = response.status_code
+            MoodleAPI._check_status(response)
+
+    # throttled and traced request, the throttle wait is not part of the span
+    @staticmethod
+    @contextlib.contextmanager
+    def _request(method: str, url: str):
+        with Throttle.get(url).request(url), Trace.request(method, url) as span:
+            yield span
+
+    @staticmethod
+    def _check_status(response):
+        if response.status_code >= 500:
+            raise ServerError(str(response.status_code) + " " + response.url)
+
+    def _is_login_page(self) -> bool:
+        return self._page_url().startswith(self.urlHandler.login())
+
+    # url of the current page, after redirects
+    def _page_url(self) -> str:
+        return self.browser.get_url()
+
+    # first form of the current page, filled with form[name] = value and sent by _submit
+    def _select_form(self):
+        return self.browser.select_form(nr=0)
+
+    def _form_html(self) -> str:
+        return str(self.browser.page.find("form"))
+
+    # shows a page already known as if it was loaded from url
+    def _load_page(self, url: str, page: str):
+        self.browser.open_fake_page(page, url=url)
+
+    def _page_has_error(self) -> bool:
+        return self.browser.page is not None and self.browser.page.select_one(".errorbox") is not None
+
+    def _accepted(self, check: Optional[Callable[[], bool]]) -> bool:
+        if self.status >= 400 or self._is_login_page() or self._page_has_error():
+            return False
+        return check is None or check()
+
+    # loads the page of the form in url and submits it after fill(form)
+    # forms with a kind are learned once per login and later filled from the template without loading the
+    # page: the hidden fields named as the parameters of url (ids, section) are taken from url
+    # a template refused by moodle (error box, login page, 4xx or check failing) is dropped and the form
+    # is sent again from its page
+    def _send_form(self, url: str, fill: Callable[[Any], None], kind: Optional[str] = None,
+                   check: Optional[Callable[[], bool]] = None):
+        url = url.strip()
+        template = FormTemplates.get(kind, self) if kind is not None else None
+        if template is not None:
+            try:
+                self._load_page(template[0], template[1])
+                form = self._select_form()
+                for name, value in urllib.parse.parse_qsl(urllib.parse.urlparse(url).query):
+                    try:
+                        form[name] = value
+                    except (LookupError, mechanicalsoup.LinkNotFoundError):
+                        pass  # parameter that is not a field
+                fill(form)
+                self._submit()
+                if self._accepted(check):
+                    return
+            except (LookupError, mechanicalsoup.LinkNotFoundError):  # field of this vpl missing in the template
+                pass
+            FormTemplates.drop(kind, self)
+        self.open_url(url)
+        page_url, form_html = self._page_url(), self._form_html() if kind is not None else ""
+        fill(self._select_form())
+        self._submit()
+        if kind is not None and self._accepted(check):
+            FormTemplates.learn(kind, self, page_url, form_html)
+
+    # feeds the page to the parser while it is downloaded, without building the browser soup
+    def stream_page(self, url: str, parser: html.parser.HTMLParser):
+        generation = self.sessions.generation
+        response = self._stream(url)
+        if response.url.startswith(self.urlHandler.login()):
+            response.close()
+            self.sessions.renew(self, generation)
+            response = self._stream(url)
+        response.encoding = response.encoding or 'utf-8'
+        with response:
+            for chunk in response.iter_content(chunk_size=65536, decode_unicode=True):
+                parser.feed(chunk)
+        Trace.streamed(response)
+        parser.close()
+
+    def _stream(self, url: str):
+        timeout = MoodleAPI.default_timeout if MoodleAPI.default_timeout != 0 else None
+        with self._request("GET", url) as span:
+            response = self.browser.session.get(url, timeout=timeout, stream=True)
+            Trace.response(span, response, stream=True)
+            if response.status_code >= 500:
+                response.close()
+            MoodleAPI._check_status(response)
+        return response
+
+    def _open(self, url: str, data_files: Optional[Any] = None):
+        with self._request("GET", url) as span:
+            if MoodleAPI.default_timeout != 0:
+                if data_files is None:
+                    response = self.browser.open(url, timeout=MoodleAPI.default_timeout)
+                else:
+                    response = self.browser.open(url, timeout=MoodleAPI.default_timeout, data=data_files)
             else:
-                self.browser.open(url, data=data_files)
+                if data_files is None:
+                    response = self.browser.open(url)
+                else:
+                    response = self.browser.open(url, data=data_files)
+            Trace.response(span, response)
+            self.status = response.status_code
+            MoodleAPI._check_status(response)
 
     def _login(self):
-        self.browser.open(self.urlHandler.login())
-        self.browser.select_form(nr=0)
-        self.browser['username'] = self.credentials.username
-        self.browser['password'] = self.credentials.password
-        self.browser.submit_selected()
-        if self.browser.get_url() == self.urlHandler.login():
+        with self._request("GET", self.urlHandler.login()) as span:
+            response = self.browser.open(self.urlHandler.login(), timeout=MoodleAPI.default_timeout or None)
+            Trace.response(span, response)
+            MoodleAPI._check_status(response)
+        self._login_form()
+
+    def _login_form(self):
+        form = self._select_form()
+        form['username'] = self.credentials.username
+        form['password'] = self.credentials.password
+        self._submit()
+        if self._page_url() == self.urlHandler.login():
             print("Erro de login, verifique login e senha")
             exit(0)
 
     def delete(self, qid: int):
         Bar.send("load")
-        self.open_url(self.urlHandler.delete_vpl(qid))
-        Bar.send("submit")
-        self.browser.select_form(nr=0)
-        self.browser.submit_selected()
+        self._send_form(self.urlHandler.delete_vpl(qid), lambda form: Bar.send("submit"), "delete")
 
+    # title and description come from view.php, the files from the json endpoints used to send them
+    # the files shown in view.php are kept when the endpoints are not available
     def download(self, vplid: int) -> JsonVPL:
         url = self.urlHandler.view_vpl(vplid)
 
         Bar.send("open")
-        self.open_url(url)
-        Bar.send("parse")
-        soup = self.browser.page
-        arqs = soup.findAll('h4', {'id': lambda value: value and value.startswith("fileid")})
-        title = soup.find('a', {'href': self.browser.get_url()}).get_text()
-        descr = soup.find('div', {'class': 'box py-3 generalbox'}).find('div', {'class': 'no-overflow'}).get_text()
-
-        vpl = JsonVPL(title, descr)
-        for arq in arqs:
-            cont = soup.find('pre', {'id': 'code' + arq.get('id')})
-            file = JsonFile(name=arq.get_text(), contents=cont.get_text())
-            if arq.find_previous_sibling('h2').get_text() == "Arquivos requeridos":
-                vpl.required.append(file)
-            else:
-                vpl.upload.append(file)
+        page = VplPageParser(url)
+        self.stream_page(url, page)
+        vpl = page.vpl()
+        if MoodleAPI.json_download:
+            Bar.send("files")
+            try:
+                upload = self.load_files(self.urlHandler.load_execution_files(vplid))
+                required = self.load_files(self.urlHandler.load_required_files(vplid))
+                vpl.upload, vpl.required = upload, required
+            except (ValueError, KeyError, TypeError):
+                MoodleAPI.json_download = False
+                Bar.send("html")
         return vpl
 
-    def set_duedate_field_in_form(self, duedate: Optional[str]):
+    # files with their exact contents and encoding, as in {"success": true, "response": {"files": [...]}}
+    def load_files(self, url: str) -> List[JsonFile]:
+        page = TextPage()
+        self.stream_page(url, page)
+        data = json.loads(page.text())
+        if not data.get("success"):
+            raise ValueError("json endpoint failed: " + url)
+        files = []
+        for entry in data["response"]["files"]:
+            files.append(JsonFile(entry["name"], entry["contents"], int(entry.get("encoding", 0))))
+        return files
+
+    @staticmethod
+    def set_duedate_field_in_form(form, duedate: Optional[str]):
         if duedate is None:  # unchange default
             return
 
         if duedate == "0":  # disable
-            self.browser["duedate[enabled]"] = False
+            form["duedate[enabled]"] = False
             return
-        self.browser["duedate[enabled]"] = True
+        form["duedate[enabled]"] = True
         year, month, day, hour, minute = duedate.split(":")
 
-        self.browser["duedate[year]"] = year
-        self.browser["duedate[month]"] = str(int(month))  # tranform 05 to 5
-        self.browser["duedate[day]"] = str(int(day))
-        self.browser["duedate[hour]"] = str(int(hour))
-        self.browser["duedate[minute]"] = str(int(minute))
+        form["duedate[year]"] = year
+        form["duedate[month]"] = str(int(month))  # tranform 05 to 5
+        form["duedate[day]"] = str(int(day))
+        form["duedate[hour]"] = str(int(hour))
+        form["duedate[minute]"] = str(int(minute))
 
     def update_duedate_only(self, url: str, duedate: Optional[str] = None):
         Bar.send("duedate")
         self.open_url(url)
-        self.browser.select_form(nr=0)
-        self.set_duedate_field_in_form(duedate)
-        self.browser.form.choose_submit("submitbutton")
-        self.browser.submit_selected()
+        form = self._select_form()
+        self.set_duedate_field_in_form(form, duedate)
+        form.choose_submit("submitbutton")
+        self._submit()
 
     def send_basic_info(self, url: str, vpl: JsonVPL, duedate: Optional[str] = None) -> int:
-        self.open_url(url)
-        Bar.send("info")
-
-        self.browser.select_form(nr=0)
-        self.browser['name'] = vpl.title
-        self.browser['introeditor[text]'] = vpl.description
-        self.set_duedate_field_in_form(duedate)
-        self.browser['maxfiles'] = max(len(vpl.keep), 3)
-        self.browser.form.choose_submit("submitbutton")
-        self.browser.submit_selected()
+        def fill(form):
+            Bar.send("info")
+            form['name'] = vpl.title
+            form['introeditor[text]'] = vpl.description
+            self.set_duedate_field_in_form(form, duedate)
+            form['maxfiles'] = max(len(vpl.keep), 3)
+            form.choose_submit("submitbutton")
 
         if url.find("update") != -1:
-            qid = URLHandler.parse_id_from_update(url)
-        else:
-            url2 = self.browser.get_url()
-            qid = URLHandler.parse_id(url2)
-        return int(qid)
+            self._send_form(url, fill)
+            return int(URLHandler.parse_id_from_update(url))
+        # a new vpl is shown after saved
+        self._send_form(url, fill, "add", lambda: URLHandler.is_vpl_url(self._page_url()))
+        qid = int(URLHandler.parse_id(self._page_url()))
+        MoodleAPI.created.add((self.urlHandler.base(), qid))
+        return qid
 
     def _send_vpl_files(self, url: str, vpl_files: List[JsonFile]):
-        params = {'files': vpl_files, 'comments': ''}
-        files = json.dumps(params, default=self.__dumper, indent=2)
-        self.open_url(url, files)
+        self.open_url(url, FilesPayload(vpl_files))
 
     def set_keep(self, qid: int, keep_size: int):
-        self.open_url(self.urlHandler.keep_files(qid))
-        self.browser.select_form(nr=0)
-        for index in range(4, 4 + keep_size):
-            self.browser["keepfile" + str(index)] = "1"
-        self.browser.submit_selected()
+        def fill(form):
+            for index in range(4, 4 + keep_size):
+                form["keepfile" + str(index)] = "1"
+
+        self._send_form(self.urlHandler.keep_files(qid), fill)
 
     def send_files(self, vpl: JsonVPL, qid: int):
-        self._send_vpl_files(self.urlHandler.execution_files(qid), vpl.keep + vpl.upload)  # don't change this order
+        self.send_execution_files(vpl, qid)
         if len(vpl.required) > 0:
-            self._send_vpl_files(self.urlHandler.required_files(qid), vpl.required)
+            self.send_required_files(vpl, qid)
+
+    def send_execution_files(self, vpl: JsonVPL, qid: int):
+        self._send_vpl_files(self.urlHandler.execution_files(qid), vpl.keep + vpl.upload)  # don't change this order
+
+    def send_required_files(self, vpl: JsonVPL, qid: int):
+        self._send_vpl_files(self.urlHandler.required_files(qid), vpl.required)
 
     def set_execution_options(self, qid):
-        self.open_url(self.urlHandler.execution_options(qid))
-
-        self.browser.select_form(nr=0)
-
-        self.browser['run'] = "1"
-        self.browser['debug'] = "1"
-        self.browser['evaluate'] = "1"
-        # self.browser.submit()
-        #
-        # self.browser.select_form(action='executionoptions.php')
-        self.browser['automaticgrading'] = "1"
-        self.browser.submit_selected()
-        Bar.send("exec")
+        def fill(form):
+            for name, value in MoodleAPI.execution_options.items():
+                form[name] = value
 
-    @staticmethod
-    def __dumper(obj):
-        try:
-            return obj.to_json()
-        except AttributeError:
-            return obj.__dict__
+        # the other options of a vpl are kept only when its own form is loaded
+        created = (self.urlHandler.base(), qid) in MoodleAPI.created
+        self._send_form(self.urlHandler.execution_options(qid), fill, "options" if created else None)
+        Bar.send("exec")
 
 
 class Add:
     def __init__(self, section: Optional[int], duedate: Optional[str], source_mode: SourceMode, merge_mode: MergeMode,
-                 structure=None):
+                 structure=None, sync: bool = False):
         self.section: Optional[int] = 0 if section is None else section
         self.duedate = "0" if duedate is None else duedate
         self.source_mode = source_mode
         self.merge_mode = merge_mode
+        self.sync = sync  # skip updates whose content was already pushed
         if structure is None:
-            self.structure = StructureLoader.load()
+            self.structure = StructureLoader.load([self.section])
         else:
             self.structure = structure
+        # targets with the same label are never sent at the same time
+        self._label_locks: Dict[str, threading.Lock] = {}
+        self._label_locks_guard = threading.Lock()
 
     def send_basic(self, api: MoodleAPI, vpl: JsonVPL, url: str) -> int:
         Bar.send("description")
-        while True:
-            try:
-                qid = api.send_basic_info(url, vpl, self.duedate)
-                break
-            except Exception as _e:
-                print(type(_e))  # debug
-                print(_e)
-                api = MoodleAPI()
-                Bar.send("!", 0)
-        return qid
+        return Retry.call(lambda: api.send_basic_info(url, vpl, self.duedate))
+
+    # creating is not idempotent: a create that failed by timeout or 5xx may have been saved by moodle,
+    # so before sending it again the section is loaded and a newer vpl with the same title is taken
+    def send_new(self, api: MoodleAPI, vpl: JsonVPL, url: str) -> int:
+        last = self._last_id(vpl.title)
+        sent: List[bool] = []
+
+        def create() -> int:
+            if len(sent) > 0:
+                qid = self._saved_qid(api, vpl.title, last)
+                if qid is not None:
+                    return qid
+            sent.append(True)
+            return api.send_basic_info(url, vpl, self.duedate)
+
+        Bar.send("description")
+        return Retry.call(create)
+
+    def _saved_qid(self, api: MoodleAPI, title: str, last: int) -> Optional[int]:
+        page = StructureLoader._parse(api, api.urlHandler.course_section(self.section)).structure(partial=True)
+        saved = [item.id for item in page.get_itens(self.section)
+                 if item.title == title and item.id > last and not self.structure.has_id(item.id)]
+        if len(saved) == 0:
+            return None
+        print("(saved by the failed attempt) ", end="", flush=True)
+        MoodleAPI.created.add((api.urlHandler.base(), max(saved)))
+        return max(saved)
 
     @staticmethod
     def set_keep(api: MoodleAPI, qid: int, keep_size: int):
         Bar.send("setkeep")
-        while True:
-            try:
-                api.set_keep(qid, keep_size)
-                break
-            except Exception as _e:
-                print(type(_e))  # debug
-                print(_e)
-                api = MoodleAPI()
-                Bar.send("!", 0)
+        Retry.call(lambda: api.set_keep(qid, keep_size))
 
     @staticmethod
-    def update_extra(api: MoodleAPI, vpl: JsonVPL, qid: int):
+    def set_execution_options(api: MoodleAPI, qid: int):
         Bar.send("enable")
-        while True:
-            try:
-                api.set_execution_options(qid)
-                break
-            except Exception as _e:
-                print(type(_e))  # debug
-                print(_e)
-                api = MoodleAPI()
-                Bar.send("!", 0)
+        Retry.call(lambda: api.set_execution_options(qid))
 
+    @staticmethod
+    def send_files(api: MoodleAPI, vpl: JsonVPL, qid: int, execution: bool = True, required: bool = True):
         Bar.send("send")
-        while True:
-            try:
-                api.send_files(vpl, qid)
-                break
-            except Exception as _e:
-                print(type(_e))  # debug
-                print(_e)
-                api = MoodleAPI()
-                Bar.send("!", 0)
+        if execution:
+            Retry.call(lambda: api.send_execution_files(vpl, qid))
+        if required:
+            Retry.call(lambda: api.send_required_files(vpl, qid))
+
+    @staticmethod
+    def stage_done(key: str, qid: int, stage: str, fingerprint: str):
+        SyncState.set(qid, stage, fingerprint)
+        Journal.done(key, stage)
+
+    # runs the stages after the basic info, recording each one when done
+    def send_stages(self, api: MoodleAPI, vpl: JsonVPL, qid: int, fingerprints: Dict[str, str], stages: List[str],
+                    pushed: Dict[str, str], key: str):
+        if "exec_options" in stages:
+            self.set_execution_options(api, qid)
+            self.stage_done(key, qid, "exec_options", fingerprints["exec_options"])
+        # empty required files are only sent to clear the ones sent before
+        required = "required_files" in stages and (len(vpl.required) > 0 or "required_files" in pushed)
+        if "exec_files" in stages or required:
+            self.send_files(api, vpl, qid, execution="exec_files" in stages, required=required)
+            for stage in ("exec_files", "required_files"):
+                if stage in stages:
+                    self.stage_done(key, qid, stage, fingerprints[stage])
+        if "keep" in stages:
+            self.set_keep(api, qid, len(vpl.keep))
+            self.stage_done(key, qid, "keep", fingerprints["keep"])
+
+    # id of the newest vpl with this title in the section, 0 if none
+    def _last_id(self, title: str) -> int:
+        return max([item.id for item in self.structure.get_itens(self.section) if item.title == title], default=0)
+
+    # vpl created by the interrupted run for this key, None if it still has to be created
+    # a create that was planned but not confirmed is found by a newer id with the same title
+    def _created_qid(self, key: str, title: str, journal: Dict[str, Tuple[str, str]]) -> Optional[int]:
+        state, value = journal.get("create", ("", ""))
+        if state == "done":
+            return int(value)
+        if state == "planned" and self._last_id(title) > int(value or 0):
+            return self._last_id(title)
+        return None
+
+    # target_key is the position of the target in the command and the target, the same when the run is resumed
+    def apply_action(self, vpl: JsonVPL, item: Optional[StructureItem], target_key: str):
+        fingerprints = vpl.fingerprints(self.duedate)
+        stages = list(fingerprints.keys())
+        pushed: Dict[str, str] = {}
+        if item is not None and self.merge_mode == MergeMode.UPDATE:
+            key = str(item.id)
+        else:
+            key = "new:" + str(self.section) + ":" + target_key
+        journal = Journal.get(key)
+        if journal.get("item", ("", ""))[0] == "done":
+            print("    - Skipping: Already done by the resumed run: " + vpl.title)
+            return
+        stages = [stage for stage in stages if journal.get(stage, ("", ""))[0] != "done"]
+        if item is not None and self.merge_mode == MergeMode.UPDATE and self.sync:
+            pushed = SyncState.get(item.id)
+            stages = [stage for stage in stages if pushed.get(stage) != fingerprints[stage]]
+            if len(stages) == 0:
+                print("    - Unchanged: Same content already sent to " + str(item.id) + ": " + item.title)
+                return
 
-    def apply_action(self, vpl: JsonVPL, item: Optional[StructureItem]):
-        api = MoodleAPI()  # creating new browser for each attempt to avoid some weird timeout
+        api = MoodleAPI.create()  # creating new browser for each attempt to avoid some weird timeout
 
         if item is not None and self.merge_mode == MergeMode.UPDATE:
-            print("    - Updating: Label found in " + str(item.id) + ": " + item.title)
+            changed = " (" + ", ".join(stages) + ")" if self.sync else ""
+            print("    - Updating: Label found in " + str(item.id) + ": " + item.title + changed)
             url = api.urlHandler.update_vpl(item.id)
             Bar.open()
-            self.send_basic(api, vpl, url)
-            self.update_extra(api, vpl, item.id)
-            self.set_keep(api, item.id, len(vpl.keep))
+            Trace.set_vpl(item.id)
+            Journal.plan(key, stages)
+            if "info" in stages:
+                self.send_basic(api, vpl, url)
+                self.stage_done(key, item.id, "info", fingerprints["info"])
+                if item.title != vpl.title:
+                    self.structure.set_title(item.id, vpl.title)
+                    StructureCache.mark(self.structure)
+            self.send_stages(api, vpl, item.id, fingerprints, stages, pushed, key)
+            Journal.done(key)
             Bar.done()
         elif item is not None and self.merge_mode == MergeMode.SKIP:
             print("    - Skipping: Label found in " + str(item.id) + ": " + item.title)
         else:  # new
-            print("    - Creating: New entry with title: " + vpl.title)
-            Bar.open()
-            url = api.urlHandler.new_vpl(self.section)
-            qid = self.send_basic(api, vpl, url)
-            Bar.send(str(qid))
-            self.update_extra(api, vpl, qid)
-            self.set_keep(api, qid, len(vpl.keep))
-            self.structure.add_entry(self.section, qid, vpl.title)
+            qid = self._created_qid(key, vpl.title, journal)
+            if qid is None:
+                print("    - Creating: New entry with title: " + vpl.title)
+                Bar.open()
+                Journal.plan(key, ["create"] + stages, str(self._last_id(vpl.title)))
+                url = api.urlHandler.new_vpl(self.section)
+                qid = self.send_new(api, vpl, url)
+                Journal.done(key, "create", str(qid))
+                Trace.set_vpl(qid)
+                Bar.send(str(qid))
+                SyncState.remove(qid)
+                self.stage_done(key, qid, "info", fingerprints["info"])
+            else:  # created by the interrupted run, only the missing stages are sent
+                print("    - Finishing: Entry " + str(qid) + " created by the resumed run: " + vpl.title)
+                Bar.open()
+                Journal.done(key, "create", str(qid))
+                Trace.set_vpl(qid)
+                stages = [stage for stage in stages if stage != "info"]
+            self.send_stages(api, vpl, qid, fingerprints, stages, pushed, key)
+            if not self.structure.has_id(qid):
+                self.structure.add_entry(self.section, qid, vpl.title)
+                StructureCache.mark(self.structure)
+            Journal.done(key)
             Bar.done()
 
-    def add_target(self, target: str):
+    def _label_lock(self, label: str) -> threading.Lock:
+        with self._label_locks_guard:
+            if label not in self._label_locks:
+                self._label_locks[label] = threading.Lock()
+            return self._label_locks[label]
+
+    def add_target(self, target: str, position: int = 0):
         print("- Target: " + target)
-        vpl = JsonVplLoader.load(target, self.source_mode)
-        itens_label_match = self.structure.search_by_label(StructureItem.parse_label(vpl.title), self.section)
-        item = None if len(itens_label_match) == 0 else itens_label_match[0]
-        while True:
+        self.add_vpl(JsonVplLoader.load(target, self.source_mode), str(position) + ":" + target)
+
+    # target already loaded by the Prefetcher, position is its index in the target list
+    def add_loaded(self, position: int, target: str, vpl: Optional[JsonVPL], log: str):
+        print("- Target: " + target)
+        print(log, end="")
+        if vpl is None:
+            exit(1)
+        self.add_vpl(vpl, str(position) + ":" + target)
+
+    def add_vpl(self, vpl: JsonVPL, target_key: str):
+        label = StructureItem.parse_label(vpl.title)
+        with self._label_lock(label):
+            itens_label_match = self.structure.search_by_label(label, self.section)
+            item = None if len(itens_label_match) == 0 else itens_label_match[0]
             try:
-                self.apply_action(vpl, item)
-                return
-            except Exception as _e:
-                print(type(_e))  # debug
-                print(_e)
-                Bar.fail(":" + str(_e))
+                self.apply_action(vpl, item, target_key)
+            except RetryBudgetError:
+                raise
+            except Exception as _e:  # retries are over for this target, keep going with the others
+                Bar.fail(": " + type(_e).__name__ + ": " + str(_e))
+
+    # the next targets are loaded while up to jobs targets are sent, each one with its own MoodleAPI
+    def add_targets(self, targets: List[str], jobs: int = 1):
+        loaded_list = Prefetcher.load_all(targets, self.source_mode)
+        Workers.run(self.add_loaded, ((position,) + loaded for position, loaded in enumerate(loaded_list)), jobs)
 
 
 class Update:
 
+    # sections read by load_itens, None when it needs the whole course
+    @staticmethod
+    def load_sections(args_all, args_section, args_ids, args_labels) -> Optional[List[int]]:
+        if args_all or args_ids or args_labels or not args_section:
+            return None
+        return args_section
+
     @staticmethod
     def load_itens(args_all, args_section, args_ids, args_labels, structure):
         item_list = []
@@ -668,44 +2559,294 @@ class Update:
                     print("    - id not found: ", qid)
         if args_labels:
             for label in args_labels:
-                item_list += [item for item in structure.get_itens() if item.label == label]
+                item_list += structure.search_by_label(label)
         return item_list
 
     @staticmethod
-    def from_remote(item_list, duedate, structure):
+    def from_remote(item_list, duedate, structure, jobs: int = 1, sync: bool = False):
+        labeled = []
         for item in item_list:
-            print("- Updating: " + str(item))
             if item.label == "":
+                print("- Updating: " + str(item))
                 print("    - Skipping: No label found")
-                continue
-            action = Add(item.section, duedate=duedate, source_mode=SourceMode.REMOTE, merge_mode=MergeMode.UPDATE,
-                         structure=structure)
-            action.add_target(item.label)
+            else:
+                labeled.append(item)
+
+        # one Add for each section, so the workers share its label locks
+        actions = {section: Add(section, duedate=duedate, source_mode=SourceMode.REMOTE,
+                                merge_mode=MergeMode.UPDATE, structure=structure, sync=sync)
+                   for section in set(item.section for item in labeled)}
+
+        def update_item(position: int, item: StructureItem, loaded: Tuple[str, Optional[JsonVPL], str]):
+            print("- Updating: " + str(item))
+            actions[item.section].add_loaded(position, *loaded)
+
+        loaded_list = Prefetcher.load_all([item.label for item in labeled], SourceMode.REMOTE)
+        Workers.run(update_item, ((position, item, loaded) for position, (item, loaded)
+                                  in enumerate(zip(labeled, loaded_list))), jobs)
 
     @staticmethod
     def exec_or_duedate(item_list, args_exec_options, args_duedate):
-        i = 0
-        api = MoodleAPI()
-        while i < len(item_list):
-            item = item_list[i]
+        api = MoodleAPI.create()
+        for item in item_list:
             print("- Change execution options for " + str(item.id))
             print("    -", str(item))
+            key = "options:" + str(item.id)
+            if Journal.is_done(key):
+                print("    - Skipping: Already done by the resumed run")
+                continue
             try:
                 Bar.open()
+                Trace.set_vpl(item.id)
+                Journal.plan(key, [])
                 if args_exec_options:
-                    api.set_execution_options(item.id)
+                    Retry.call(lambda: api.set_execution_options(item.id))
 
                 if args_duedate:
                     url = api.urlHandler.update_vpl(item.id)
-                    api.update_duedate_only(url, args_duedate)
-
-                i += 1
+                    Retry.call(lambda: api.update_duedate_only(url, args_duedate))
+                Journal.done(key)
                 Bar.done()
+            except RetryBudgetError:
+                raise
             except Exception as _e:
-                api = MoodleAPI()
-                print(type(_e))  # debug
-                print(_e)
-                Bar.fail(": timeout")
+                Bar.fail(": " + type(_e).__name__ + ": " + str(_e))
+
+
+class Down:
+    _local = threading.local()
+
+    @staticmethod
+    def _api() -> MoodleAPI:
+        if getattr(Down._local, "api", None) is None:
+            Down._local.api = MoodleAPI.create()
+        return Down._local.api
+
+    # runs in the fetcher threads, the bar goes to the returned text
+    @staticmethod
+    def fetch(item: StructureItem) -> Tuple[StructureItem, Optional[JsonVPL], str]:
+        vpl = None
+        with Output.capture() as log:
+            Bar.open()
+            Trace.set_vpl(item.id)
+            try:
+                vpl = Retry.call(lambda: Down._api().download(item.id))
+            except RetryBudgetError:
+                raise
+            except Exception as _e:
+                print("(" + type(_e).__name__ + ": " + str(_e) + ") ", end="")
+            Trace.stage(None)  # done or fail is printed by the writer thread
+        return item, vpl, "".join(log)
+
+    # the fetchers download in parallel and each vpl is written as soon as it arrives
+    @staticmethod
+    def save_all(item_list: List[StructureItem], output_dir: str, jobs: int = 1):
+        Output.install()
+        failed: List[StructureItem] = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+            futures = [pool.submit(Down.fetch, item) for item in item_list]
+            for future in concurrent.futures.as_completed(futures):
+                item, vpl, log = future.result()
+                print("- Saving id " + str(item.id))
+                print("    -", str(item))
+                print(log, end="")
+                if vpl is None:
+                    failed.append(item)
+                    Bar.fail()
+                    continue
+                path = os.path.normpath(os.path.join(output_dir, str(item.id) + ".json"))
+                with open(path, "w") as f:
+                    f.write(str(vpl))
+                Bar.done(": " + path)
+        if len(failed) > 0:
+            print("- Failed ids: " + " ".join(str(item.id) for item in failed))
+
+
+# sends each printed text to the client of the daemon as a json line
+class DaemonOutput:
+    def __init__(self, connection: socket.socket):
+        self.connection = connection
+
+    def send(self, message: Dict[str, Any]):
+        try:
+            self.connection.sendall((json.dumps(message) + "\n").encode())
+        except OSError:
+            pass  # the client went away, the command still finishes
+
+    def write(self, text: str):
+        if text:
+            self.send({"out": text})
+
+    def flush(self):
+        pass
+
+
+# "mapi serve" keeps the login session, the course structure and the remote cache in memory
+# the other commands are sent through a unix socket in .mapi_cache while the daemon runs
+# one command runs at a time, in the working directory of the client
+class Daemon:
+    idle: float = 3600.0
+    # class settings changed by the command line, restored before each command
+    settings = [(StructureCache, "refresh"), (RemoteCache, "offline"), (MoodleAPI, "default_timeout"),
+                (Trace, "path"), (Trace, "chrome"), (Prefetcher, "depth")]
+
+    @staticmethod
+    def socket_path() -> str:
+        key = hashlib.sha1(os.path.abspath(Credentials.config_path).encode()).hexdigest()[:16]
+        return os.path.join(Credentials.cache_dir(), "daemon_" + key + ".sock")
+
+    @staticmethod
+    def _connect() -> Optional[socket.socket]:
+        path = Daemon.socket_path()
+        if not os.path.exists(path):
+            return None
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            client.connect(path)
+        except OSError:  # left by a daemon that was killed
+            client.close()
+            return None
+        return client
+
+    # runs the command in the daemon, None when it is not running
+    @staticmethod
+    def forward(message: Dict[str, Any]) -> Optional[int]:
+        client = Daemon._connect()
+        if client is None:
+            return None
+        with client, client.makefile("r", encoding="utf-8") as answers:
+            client.sendall((json.dumps(message) + "\n").encode())
+            for line in answers:
+                answer = json.loads(line)
+                if "exit" in answer:
+                    return answer["exit"]
+                sys.stdout.write(answer["out"])
+                sys.stdout.flush()
+        print("\nfail: the daemon closed the connection")
+        return 1
+
+    @staticmethod
+    def serve(parser: argparse.ArgumentParser):
+        if Daemon._connect() is not None:
+            print("- Daemon already running for " + Credentials.config_path)
+            return
+        path = Daemon.socket_path()
+        if os.path.exists(path):
+            os.remove(path)
+        Credentials.load_credentials()
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o177)  # only the owner can talk to a logged daemon
+        try:
+            server.bind(path)
+        finally:
+            os.umask(umask)
+        server.listen(8)
+        server.settimeout(Daemon.idle or None)
+
+        StructureCache.keep_in_memory = True
+        Output.install()
+        defaults = [(owner, name, getattr(owner, name)) for owner, name in Daemon.settings]
+        print("- Daemon listening on " + path)
+        Daemon._run_guarded(lambda: StructureLoader.load())  # also logs in
+        try:
+            while True:
+                try:
+                    connection, _ = server.accept()
+                except socket.timeout:
+                    print("- Daemon idle for " + str(int(Daemon.idle)) + "s, stopping")
+                    return
+                with connection, connection.makefile("r", encoding="utf-8") as lines:
+                    message = json.loads(lines.readline() or "{}")
+                    output = DaemonOutput(connection)
+                    if message.get("stop"):
+                        output.send({"exit": 0})
+                        print("- Daemon stopped")
+                        return
+                    if "argv" not in message:
+                        continue
+                    print("- " + " ".join(message["argv"]))
+                    for owner, name, value in defaults:
+                        setattr(owner, name, value)
+                    output.send({"exit": Daemon._command(parser, message, output)})
+        finally:
+            server.close()
+            os.remove(path)
+
+    @staticmethod
+    def _command(parser: argparse.ArgumentParser, message: Dict[str, Any], output: DaemonOutput) -> int:
+        cwd = os.getcwd()
+        stdout = Output._stdout
+        Output._stdout = output
+        try:
+            os.chdir(message["cwd"])
+            args = parser.parse_args(message["argv"])
+            Retry.instances.clear()
+            Throttle.instances.clear()
+            Trace.spans = []
+            Trace.start = time.time()
+            MoodleAPI.created.clear()
+            Journal.runs.clear()
+            configure(args)
+            return Daemon._run_guarded(lambda: run(args))
+        except SystemExit as e:
+            return e.code if isinstance(e.code, int) else 1
+        finally:
+            Output._stdout = stdout
+            ContentStore.clear()
+            os.chdir(cwd)
+
+    # the daemon survives the errors and exits of a command
+    @staticmethod
+    def _run_guarded(action: Callable[[], Any]) -> int:
+        try:
+            code = action()
+            return code if isinstance(code, int) else 0
+        except SystemExit as e:
+            return e.code if isinstance(e.code, int) else 1
+        except Exception:
+            print(traceback.format_exc(), end="")
+            return 1
+
+
+# runs the same command on several courses at the same time, one config file for each course
+# the vpls of the targets are loaded once for all of them and the output of each course is shown
+# together when it finishes, followed by a summary
+class FanOut:
+    commands = ["add", "update", "sync", "rm", "list"]
+
+    @staticmethod
+    def run(args) -> int:
+        courses = [Credentials.from_config(path) for path in args.config]  # passwords are asked here
+        Output.install()
+        JsonVplLoader.shared = {}
+        print("- Running on " + str(len(courses)) + " courses: " + ", ".join(str(URLHandler(c)) for c in courses))
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(courses)) as pool:
+                futures = [pool.submit(contextvars.copy_context().run, FanOut._course, args, path, credentials)
+                           for path, credentials in zip(args.config, courses)]
+                results = [future.result() for future in futures]
+        finally:
+            JsonVplLoader.shared = None
+
+        print("- Summary")
+        print("    %-30s %6s %6s %8s %5s" % ("course", "done", "fail", "time", "exit"))
+        for credentials, (tally, elapsed, code) in zip(courses, results):
+            print("    %-30s %6d %6d %7.1fs %5d" % (str(URLHandler(credentials)), tally["done"], tally["fail"],
+                                                   elapsed, code))
+        return max(code for _, _, code in results)
+
+    @staticmethod
+    def _course(args, path: str, credentials: Credentials) -> Tuple[collections.Counter, float, int]:
+        Credentials.active.set(credentials)
+        tally: collections.Counter = collections.Counter()
+        Bar.tally.set(tally)
+        start = time.time()
+        with Output.capture() as log:
+            code = Daemon._run_guarded(lambda: run_command(args))
+        elapsed = time.time() - start
+        Output.write_block("=== " + path + " (" + str(URLHandler()) + "): " + ("ok" if code == 0 else "fail") +
+                           " in " + "%.1fs" % elapsed + "\n" + "".join(log))
+        return tally, elapsed, code
 
 
 class Actions:
@@ -718,10 +2859,12 @@ class Actions:
         elif args.duplicate:
             merge_mode = MergeMode.DUPLICATE
         
-        source_mode = SourceMode.REMOTE
+        source_mode = SourceMode.LOCAL
+        Journal.start("add")
         action = Add(args.section, args.duedate, source_mode, merge_mode)
-        for target in args.targets:
-            action.add_target(target)
+        LocalBuilder.build_all(args.targets)
+        action.add_targets(args.targets, args.jobs)
+        Journal.finish()
 
     @staticmethod
     def setup(args):
@@ -747,73 +2890,84 @@ class Actions:
             print("no action (-c(content), -d(duedate), -e(exec_options)) selected")
             return
 
-        structure = StructureLoader.load()
+        Journal.start("update")
+        structure = StructureLoader.load(Update.load_sections(args.all, args.sections, args.ids, args.labels))
         item_list = Update.load_itens(args.all, args.sections, args.ids, args.labels, structure)
 
         if args_content:
-            Update.from_remote(item_list, args_duedate, structure)
+            Update.from_remote(item_list, args_duedate, structure, args.jobs)
 
         if args_exec_options or args_duedate:
             Update.exec_or_duedate(item_list, args_exec_options, args_duedate)
+        Journal.finish()
+
+    @staticmethod
+    def sync(args):
+        Journal.start("sync")
+        structure = StructureLoader.load(Update.load_sections(args.all, args.sections, args.ids, args.labels))
+        item_list = Update.load_itens(args.all, args.sections, args.ids, args.labels, structure)
+        Update.from_remote(item_list, args.duedate, structure, args.jobs, sync=True)
+        Journal.finish()
 
     @staticmethod
     def down(args):
         args_output: str = args.output
 
-        api = MoodleAPI()
-        structure = StructureLoader.load()
+        structure = StructureLoader.load(Update.load_sections(args.all, args.sections, args.ids, args.labels))
         item_list = Update.load_itens(args.all, args.sections, args.ids, args.labels, structure)
-
-        i = 0
-        while i < len(item_list):
-            item = item_list[i]
-            path = os.path.normpath(os.path.join(args_output, str(item.id) + ".json"))
-            print("- Saving id " + str(item.id))
-            print("    -", str(item))
-            try:
-                Bar.open()
-                data = api.download(item.id)
-                open(path, "w").write(str(data))
-                i += 1
-                Bar.done(": " + path)
-            except Exception as _e:
-                print(type(_e))  # debug
-                print(_e)
-                Bar.fail(": timeout")
+        Down.save_all(item_list, args_output, args.jobs)
 
     @staticmethod
     def rm(args):
-        structure = StructureLoader.load()
+        Journal.start("rm")
+        structure = StructureLoader.load(Update.load_sections(args.all, args.sections, args.ids, args.labels))
         item_list = Update.load_itens(args.all, args.sections, args.ids, args.labels, structure)
 
-        i = 0
-        while i < len(item_list):
-            api = MoodleAPI()
-            item = item_list[i]
+        api = MoodleAPI.create()
+        for item in item_list:
             print("- Removing id " + str(item.id))
             print("    -", str(item))
+            if Journal.is_done(str(item.id)):
+                print("    - Skipping: Already removed by the resumed run")
+                continue
             try:
                 Bar.open()
-                api.delete(item.id)
-                i += 1
+                Trace.set_vpl(item.id)
+                Journal.plan(str(item.id), ["delete"])
+                Retry.call(lambda: api.delete(item.id))
+                Journal.done(str(item.id), "delete")
+                structure.rm_item(item.id)
+                SyncState.remove(item.id)
+                StructureCache.mark(structure)
+                Journal.done(str(item.id))
                 Bar.done()
+            except RetryBudgetError:
+                raise
             except Exception as _e:
-                print(type(_e))  # debug
-                print(_e)
-                Bar.fail(": timeout")
+                Bar.fail(": " + type(_e).__name__ + ": " + str(_e))
+        Journal.finish()
+
+    @staticmethod
+    def serve(args):
+        if args.stop:
+            if Daemon.forward({"stop": True}) is None:
+                print("- No daemon running for " + Credentials.config_path)
+            return
+        Daemon.idle = args.idle
+        Daemon.serve(args.parser)
 
     @staticmethod
     def list(args):
         args_section: Optional[int] = args.section
         args_url: bool = args.url
-        viewer = Viewer(args_url)
+        viewer = Viewer(args_url, None if args_section is None else [args_section])
         if args_section is not None:
             viewer.list_section(args_section)
         else:
             viewer.list_all()
 
 
-def main():
+def build_parser() -> argparse.ArgumentParser:
     # p_config = argparse.ArgumentParser(add_help=False)
     # p_config.add_argument('-c', '--config', type=str, help="config file path")
 
@@ -834,17 +2988,42 @@ def main():
     p_out = argparse.ArgumentParser(add_help=False)
     p_out.add_argument('-o', '--output', type=str, default='.', action='store', help='Output directory')
 
+    p_jobs = argparse.ArgumentParser(add_help=False)
+    p_jobs.add_argument('-j', '--jobs', type=int, default=1, metavar='N', help="number of vpls processed at the same time")
+
+    p_resume = argparse.ArgumentParser(add_help=False)
+    p_resume.add_argument('--resume', action='store_true',
+                          help="continue the last interrupted run of this command, skipping the items it finished")
+
+    p_prefetch = argparse.ArgumentParser(add_help=False)
+    p_prefetch.add_argument('--prefetch', type=int, default=Prefetcher.depth, metavar='K',
+                            help="number of remote questions loaded ahead")
+
     desc = ("Gerenciar vpls do moodle de forma automatizada\n"
             "Use \"./mapi comando -h\" para obter informações do comando específico.\n\n"
             )
 
     parser = argparse.ArgumentParser(prog='mapi.py', description=desc, formatter_class=argparse.RawTextHelpFormatter)
-    parser.add_argument('-c', '--config', type=str, help="config file path")
+    parser.add_argument('-c', '--config', type=str, action='append',
+                        help="config file path, repeat it to run " + "/".join(FanOut.commands) +
+                             " on several courses at the same time")
     parser.add_argument('-t', '--timeout', type=int, help="max timeout to way moodle response")
+    parser.add_argument('-r', '--refresh', action='store_true', help="reload course structure ignoring the cache")
+    parser.add_argument('--offline', action='store_true', help="load remote questions only from the local cache")
+    parser.add_argument('--retry-budget', type=int, default=Retry.budget, metavar='N',
+                        help="max number of retries in the whole run for each moodle host")
+    parser.add_argument('--max-rate', type=float, default=Throttle.max_rate, metavar='R',
+                        help="max requests per second sent to moodle, no limit by default")
+    parser.add_argument('--no-form-templates', action='store_true',
+                        help="always load the page of a form before sending it")
+    parser.add_argument('--trace', type=str, metavar='FILE',
+                        help="save the timing of each request and stage, .json files use the chrome trace format")
+    parser.add_argument('--no-daemon', action='store_true', help="run here even when \"mapi serve\" is running")
 
     subparsers = parser.add_subparsers(title="subcommands", help="help for subcommand")
 
-    parser_add = subparsers.add_parser('add', parents=[p_section, p_duedate], help="add")
+    parser_add = subparsers.add_parser('add', parents=[p_section, p_duedate, p_jobs, p_prefetch, p_resume],
+                                       help="add")
     parser_add.add_argument('targets', type=str, nargs='+', action='store', help='file, folder ou remote with lab')
 
     group_add = parser_add.add_mutually_exclusive_group()
@@ -857,17 +3036,22 @@ def main():
     parser_list.add_argument('-u', '--url', action='store_true', help="Show vpl urls")
     parser_list.set_defaults(func=Actions.list)
 
-    parser_rm = subparsers.add_parser('rm', parents=[p_selection], help="Remove from Moodle")
+    parser_rm = subparsers.add_parser('rm', parents=[p_selection, p_resume], help="Remove from Moodle")
     parser_rm.set_defaults(func=Actions.rm)
 
-    parser_down = subparsers.add_parser('down', parents=[p_selection, p_out], help='Download vpls')
+    parser_down = subparsers.add_parser('down', parents=[p_selection, p_out, p_jobs], help='Download vpls')
     parser_down.set_defaults(func=Actions.down)
 
-    parser_update = subparsers.add_parser('update', parents=[p_selection, p_duedate], help='Update vpls')
+    parser_update = subparsers.add_parser('update', parents=[p_selection, p_duedate, p_jobs, p_prefetch, p_resume],
+                                          help='Update vpls')
     parser_update.add_argument('-c', '--content', action='store_true', help="update question content")
     parser_update.add_argument('-e', '--exec-options', action='store_true', help="enable all execution options")
     parser_update.set_defaults(func=Actions.update)
 
+    parser_sync = subparsers.add_parser('sync', parents=[p_selection, p_duedate, p_jobs, p_prefetch, p_resume],
+                                        help='Update content only of vpls changed since the last push')
+    parser_sync.set_defaults(func=Actions.sync)
+
     parser_setup = subparsers.add_parser('setup', help='config default .mapirc file')
     parser_setup.add_argument("--username", type=str, help='username')
     parser_setup.add_argument("--password", type=str, help="password")
@@ -876,16 +3060,92 @@ def main():
     parser_setup.add_argument("--remote", type=str, help="remote server")
     parser_setup.set_defaults(func=Actions.setup)
 
-    args = parser.parse_args()
-    if args.config:
-        Credentials.config_path = args.config
+    parser_serve = subparsers.add_parser('serve',
+                                         help='keep login and course structure in memory for the next commands')
+    parser_serve.add_argument('--idle', type=float, default=Daemon.idle, metavar='SECONDS',
+                              help="stop after this time without commands, 0 to never stop")
+    parser_serve.add_argument('--stop', action='store_true', help="stop the running daemon")
+    parser_serve.set_defaults(func=Actions.serve, parser=parser)
+    return parser
+
+
+# applies the global options to the class settings
+def configure(args):
     if args.timeout is not None:
         MoodleAPI.default_timeout = args.timeout
-
-    if len(sys.argv) > 1:
+    if args.refresh:
+        StructureCache.refresh = True
+    if args.offline:
+        RemoteCache.offline = True
+    Retry.budget = args.retry_budget
+    FormTemplates.enabled = not args.no_form_templates
+    Throttle.max_rate = args.max_rate
+    Throttle.max_inflight = max(1, getattr(args, "jobs", 1))
+    SessionManager.size = Throttle.max_inflight
+    if args.trace:
+        Trace.path = args.trace
+        Trace.chrome = args.trace.endswith(".json")
+    if getattr(args, "prefetch", None) is not None:
+        Prefetcher.depth = args.prefetch
+    Journal.resume = getattr(args, "resume", False)
+
+
+def run_command(args) -> int:
+    try:
         args.func(args)
-    else:
+    except RetryBudgetError as e:
+        print("\nfail: " + str(e) + ", use --retry-budget to raise it")
+        return 1
+    except (ServerError, AuthError, requests.RequestException) as e:
+        print("\nfail: moodle unavailable, " + type(e).__name__ + ": " + str(e))
+        return 1
+    finally:  # also when interrupted, the vpls already sent stay in the cache
+        StructureCache.flush()
+    return 0
+
+
+def run(args) -> int:
+    try:
+        if args.config is not None and len(args.config) > 1:
+            code = FanOut.run(args)
+        else:
+            code = run_command(args)
+    finally:
+        if Trace.enabled():
+            Trace.save()
+            Trace.summary()
+    if code != 0:
+        return code
+    if Throttle.max_inflight > 1:
+        for host, throttle in Throttle.instances.items():
+            limits = throttle.limits()
+            print("- Moodle limits" + (" of " + host if len(Throttle.instances) > 1 else "") +
+                  ": {inflight} requests in flight, {rate} ({requests} requests, {slowdowns} slowdowns)"
+                  .format(**limits))
+    return 0
+
+
+def main():
+    parser = build_parser()
+    args = parser.parse_args()
+    if getattr(args, "func", None) is None:
         parser.print_help()
+        return
+    fan_out = args.config is not None and len(args.config) > 1
+    if fan_out and args.func.__name__ not in FanOut.commands:
+        parser.error("several config files are supported only by " + ", ".join(FanOut.commands))
+    if args.config:
+        Credentials.config_path = args.config[0]
+    if Credentials.config_path is None:
+        Credentials.config_path = Credentials.load_default_config_path()
+    if args.func not in (Actions.setup, Actions.serve) and not args.no_daemon and not fan_out:
+        code = Daemon.forward({"argv": sys.argv[1:], "cwd": os.getcwd()})
+        if code is not None:
+            exit(code)
+    configure(args)
+    code = run(args)
+    if code != 0:
+        exit(code)
 
 
 if __name__ == "__main__":